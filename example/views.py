@@ -9,16 +9,12 @@ def home(request):
 
 @transaction.atomic
 def setup(request):
-	from django.conf import settings
 	from django.contrib.sites.models import Site
 	from navigation.utils import discover_sitemaps, refresh_all_menus
 	
 	
 	discover_sitemaps()
 	
-	# disable autorefresh because will be publishing many pages
-	settings.NAVIGATION_AUTO_REFRESH = False
-	
 	if Page.objects.count() == 0:
 		_create_page("Home", None)
 		_setup_life_tree()
@@ -1,10 +1,11 @@
 
 from django.contrib import admin
 from django.conf.urls import patterns
-from django.db import transaction
 from django.http import HttpResponse, HttpResponseRedirect
-from django.views.decorators.http import require_POST, require_safe
-from django.core.exceptions import SuspiciousOperation, ValidationError
+from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition, require_POST, require_safe
+from django.core.exceptions import PermissionDenied, SuspiciousOperation, ValidationError
 from django.core.urlresolvers import reverse
 
 from navigation.models import Sitemap, Menu, MenuItem
@@ -14,20 +15,19 @@ from django.conf import settings
 class SitemapAdmin(admin.ModelAdmin):
     readonly_fields=('site', 'slug')
 
-@transaction.atomic
 def refresh_items(modeladmin, request, queryset):
-    from .utils import refresh_menu_from_sitemap
-    
-    for sitemap in Sitemap.current_objects.all():
-        if sitemap.is_available():
-            for menu in queryset.all():
-                if menu.sitemap == None or menu.sitemap == sitemap:
-                    refresh_menu_from_sitemap(menu, sitemap)
-    pass
+    from .utils import refresh_menus
+    refresh_menus(queryset.all())
     
 refresh_items.short_description = "Refresh menu items"
 
 
+def _get_menu_etag(request, menu_id):
+    ''' ETag for views that show menu items; it changes when any menu changes. '''
+    from .cache import get_menu_version
+    return '%s-%s-%s' % (menu_id, get_menu_version(), request.GET.get('parent', ''))
+
+
 class MenuAdmin(admin.ModelAdmin):
     class Meta:
         pass
@@ -50,13 +50,32 @@ class MenuAdmin(admin.ModelAdmin):
         self._refresh_sitemaps()
         return super(MenuAdmin, self).changelist_view(*args, **kw)
     
-    def change_view(self, *args, **kw):
+    def change_view(self, request, *args, **kw):
         self._refresh_sitemaps()
-        return super(MenuAdmin, self).change_view(*args, **kw)
+        response = super(MenuAdmin, self).change_view(request, *args, **kw)
+        self._invalidate_after_commit(request)
+        return response
     
-    def add_view(self, *args, **kw):
+    def add_view(self, request, *args, **kw):
         self._refresh_sitemaps()
-        return super(MenuAdmin, self).add_view(*args, **kw)
+        response = super(MenuAdmin, self).add_view(request, *args, **kw)
+        self._invalidate_after_commit(request)
+        return response
+    
+    def delete_view(self, request, *args, **kw):
+        response = super(MenuAdmin, self).delete_view(request, *args, **kw)
+        self._invalidate_after_commit(request)
+        return response
+    
+    def _invalidate_after_commit(self, request):
+        ''' Invalidates menus again once the view's transaction is committed.
+        
+        Signals sent by saved items invalidate menus before the commit, so
+        other processes could cache the old items under the new version.
+        '''
+        from .cache import invalidate_menus
+        if request.method == 'POST':
+            invalidate_menus()
     
     def get_form(self, request, obj=None, **kwargs):
         form = super(MenuAdmin, self).get_form(request, obj, **kwargs)
@@ -71,65 +90,74 @@ class MenuAdmin(admin.ModelAdmin):
     def get_urls(self):
         urls = super(MenuAdmin, self).get_urls()
         my_urls = patterns('',
-            (r'^(\d)/view/', self.admin_site.admin_view(self.show_view)),
-            (r'^(\d)/refresh/', self.admin_site.admin_view(self.refresh_view)),
+            (r'^(\d+)/view/', self.admin_site.admin_view(self.show_view)),
+            (r'^(\d+)/children/', self.admin_site.admin_view(self.children_view)),
+            (r'^(\d+)/refresh/', self.admin_site.admin_view(self.refresh_view)),
+            (r'^(\d+)/patch/', self.admin_site.admin_view(self.patch_view)),
             (r'^find-sitemap-items/', self.admin_site.admin_view(self.find_sitemap_items)),
         )
         return my_urls + urls
    
     def save_model(self, request, obj, form, change):
-        super(MenuAdmin, self).save_model(request, obj, form, change)
+        from .cache import batch_invalidation
+        
+        # each saved item would invalidate menus; do it once
+        with batch_invalidation():
+            super(MenuAdmin, self).save_model(request, obj, form, change)
 
-        old_items = obj.list_all_items()
+            old_items = obj.list_all_items()
         
-        id_map = {}
+            id_map = {}
 
-        # update each item
-        if request.POST.get('menuitem-max') is not None:
-            for i in range(0, int(request.POST.get('menuitem-max')) + 1):
-                my_id = request.POST.get('menuitem-%d-id' % (i,))
-                my_order = request.POST.get('menuitem-%d-order' % (i,))
-                my_url = request.POST.get('menuitem-%d-url' % (i,))
-                my_title = request.POST.get('menuitem-%d-title' % (i,))
-                my_status = request.POST.get('menuitem-%d-status' % (i,))
-                my_sitemap_item_id = request.POST.get('menuitem-%d-sitemap-item-id' % (i,))
+            # update each item
+            if request.POST.get('menuitem-max') is not None:
+                for i in range(0, int(request.POST.get('menuitem-max')) + 1):
+                    my_id = request.POST.get('menuitem-%d-id' % (i,))
+                    my_order = request.POST.get('menuitem-%d-order' % (i,))
+                    my_url = request.POST.get('menuitem-%d-url' % (i,))
+                    my_title = request.POST.get('menuitem-%d-title' % (i,))
+                    my_status = request.POST.get('menuitem-%d-status' % (i,))
+                    my_sitemap_item_id = request.POST.get('menuitem-%d-sitemap-item-id' % (i,))
 
-                if my_id:
-                    try:
-                        item = obj.get_item(id=int(my_id))
-                    except Exception as e:
-                        item = MenuItem()
-                    item.menu = obj
-                    item.title = my_title
-                    item.url = my_url
-                    item.order = my_order
-                    item.parent = None
-                    item.sitemap_item_id = my_sitemap_item_id
-                    item.save()
+                    if my_id:
+                        try:
+                            item = obj.get_item(id=int(my_id))
+                        except Exception as e:
+                            item = MenuItem()
+                        item.menu = obj
+                        item.title = my_title
+                        item.url = my_url
+                        item.order = my_order
+                        item.parent = None
+                        item.sitemap_item_id = my_sitemap_item_id
+                        item.save()
 
-                    id_map[my_id] = item
+                        id_map[my_id] = item
 
-                    if item in old_items:
-                        old_items.remove(item)
+                        if item in old_items:
+                            old_items.remove(item)
 
-            # assign parent
-            for i in range(0, int(request.POST.get('menuitem-max')) + 1):
-                my_id = request.POST.get('menuitem-%d-id' % (i,))
-                parent_id = request.POST.get('menuitem-%s-parent-id' % (i,))
+                # assign parent
+                for i in range(0, int(request.POST.get('menuitem-max')) + 1):
+                    my_id = request.POST.get('menuitem-%d-id' % (i,))
+                    parent_id = request.POST.get('menuitem-%s-parent-id' % (i,))
 
-                if my_id:
-                    item = id_map.get(my_id)
-                    item.parent = id_map.get(parent_id)
-                    item.save()
+                    if my_id:
+                        item = id_map.get(my_id)
+                        item.parent = id_map.get(parent_id)
+                        item.save()
 
 
-            # remove old items
-            for item in old_items:
-                item.delete()
+                # remove old items
+                for item in old_items:
+                    item.delete()
+            
+                obj.clean_item_order()
         
-        # done
+            # done
         
 
+    @method_decorator(condition(etag_func=lambda request, menu_id: _get_menu_etag(request, menu_id)))
     def show_view(self, request, menu_id):
         menu = Menu.current_objects.get(pk=menu_id)
         data = { 
@@ -150,63 +178,110 @@ class MenuAdmin(admin.ModelAdmin):
         import json
         return HttpResponse(json.dumps(data), content_type="application/json")
 
-    @transaction.atomic
+    @method_decorator(condition(etag_func=lambda request, menu_id: _get_menu_etag(request, menu_id)))
+    def children_view(self, request, menu_id):
+        ''' Returns items with given parent ("parent" parameter), or top-level items. 
+        
+        Each item includes the number of its children, so the editor can load 
+        a large menu one level at a time.
+        '''
+        import json
+        from django.db.models import Count
+        
+        menu = Menu.current_objects.get(pk=menu_id)
+        parent_id = request.GET.get('parent') or None
+        if parent_id is not None:
+            try:
+                parent_id = int(parent_id)
+            except ValueError:
+                raise SuspiciousOperation("Invalid parent.")
+        
+        items = list(menu.menuitem_set.filter(my_parent=parent_id).order_by('order'))
+        counts = dict(
+            MenuItem.objects.filter(my_parent__in=[item.id for item in items])
+            .values_list('my_parent').order_by().annotate(Count('id'))
+            )
+        
+        data = {
+            'id' : menu.id,
+            'parent_id' : parent_id,
+            'items' : [],
+            }
+        for item in items:
+            item_data = self._serialize_menu_item(item)
+            item_data['children_count'] = counts.get(item.id, 0)
+            data['items'].append(item_data)
+        
+        return HttpResponse(json.dumps(data), content_type="application/json")
+
+    @method_decorator(require_POST)
+    def patch_view(self, request, menu_id):
+        ''' Applies a list of changes to menu items.
+        
+        Request body is JSON list of operations; see apply_menu_operations().
+        Returns ids of inserted items. User needs permission to change the menu.
+        '''
+        import json
+        from .utils import apply_menu_operations
+        
+        menu = get_object_or_404(Menu.current_objects, pk=menu_id)
+        if not self.has_change_permission(request, menu):
+            raise PermissionDenied
+        
+        try:
+            operations = json.loads(request.body)
+        except ValueError:
+            raise SuspiciousOperation("Invalid JSON.")
+        if not isinstance(operations, list) or not all(isinstance(operation, dict) for operation in operations):
+            raise SuspiciousOperation("Expected list of operations.")
+        
+        new_ids = apply_menu_operations(menu, operations)
+        
+        return HttpResponse(json.dumps({'ids': new_ids}), content_type="application/json")
+
     def refresh_view(self, request, menu_id):
-        from .utils import refresh_menu_from_sitemap
+        from .utils import refresh_menus
     
         menu = Menu.objects.get(pk=menu_id)
         
         if menu.sitemap:
-            refresh_menu_from_sitemap(menu, menu.sitemap)
+            refresh_menus([menu], [menu.sitemap])
         else:
-            for sitemap in Sitemap.current_objects.all():
-                if sitemap.is_available():
-                    refresh_menu_from_sitemap(menu, sitemap)
+            refresh_menus([menu])
         
         url = request.build_absolute_uri( reverse('admin:navigation_menu_change', args=[menu.id]) )
         return HttpResponseRedirect(url)    
     
     def find_sitemap_items(self, request):
+        ''' Searches sitemap items by URL ("url") or by title and URL ("term").
+        
+        Results can be paginated with "offset" and "limit"; at most 100 items are returned.
+        '''
         import json
         from .models import Sitemap
+        from .search import get_search_index
         
-        matches = []
+        try:
+            offset = max(int(request.GET.get('offset', 0)), 0)
+            limit = min(max(int(request.GET.get('limit', 100)), 0), 100)
+        except ValueError:
+            raise SuspiciousOperation("Invalid offset or limit.")
         
-        sitemap_items = []
+        indexes = []
         for sitemap in Sitemap.current_objects.all():
             if sitemap.is_available():
-                for sitemap_item in sitemap.get_items():
-                    sitemap_items.append(sitemap_item)
-                    
+                indexes.append(get_search_index(sitemap))
         
+        matches = []
         if request.GET.get('url') != None:
-            url_1 = request.GET.get('url').lower()
-            
-            for item in sitemap_items:
-                if item['location'].lower().startswith( url_1 ):
-                    matches.append( item )
+            for index in indexes:
+                matches.extend(index.find_by_url(request.GET.get('url')))
         
         if request.GET.get('term') != None:
-            title_1 = request.GET.get('term').lower()
-            url_1 = request.GET.get('term').lower()
-            url_2 = "/" + request.GET.get('term').lower()
+            for index in indexes:
+                matches.extend(index.find_by_term(request.GET.get('term')))
             
-            for item in sitemap_items:
-                if item['title'].lower().startswith( title_1 ):
-                    matches.append( item )
-                elif item['location'].lower().startswith( url_1 ):
-                    matches.append( item )
-                elif item['location'].lower().startswith( url_2 ):
-                    matches.append( item )
-            
-            if not matches:
-                for item in sitemap_items:
-                    if title_1 in item['title'].lower():
-                        matches.append( item )
-                    elif url_1 in item['url'].lower():
-                        matches.append( item )
-            
-        data = matches[:100]
+        data = matches[offset:offset + limit]
         
         return HttpResponse(json.dumps(data), content_type="application/json")
     
@@ -222,8 +297,8 @@ class MenuAdmin(admin.ModelAdmin):
             'sitemap_item_status' : None,
         }
         
-        if item.parent:
-            data['parent_id'] = item.parent.id
+        if item.my_parent_id:
+            data['parent_id'] = item.my_parent_id
         
         if item.sitemap_item_id:
             data['sitemap_item_id'] = item.sitemap_item_id
@@ -234,16 +309,14 @@ class MenuAdmin(admin.ModelAdmin):
     
     def _refresh_sitemaps(self):
         ''' Discover sitemaps if there are none yet,
-        If sitemap already exists, user has to request refresh manually '''
-        from .utils import discover_sitemaps
-        discover_sitemaps()
+        If sitemap already exists, user has to request refresh manually.
+        
+        It's done once per process; use "discover_sitemaps" command to do it again. '''
+        from .utils import ensure_sitemaps_discovered
+        ensure_sitemaps_discovered()
             
    
 admin.site.register(Menu, MenuAdmin)
 admin.site.register(Sitemap, SitemapAdmin)
 
 
-if getattr(settings, 'NAVIGATION_AUTO_REFRESH', False):
-    from .utils import initialize_autorefresh
-    initialize_autorefresh()
-
@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshQueue(object):
+    ''' Menu refreshes requested by sitemaps that changed.
+
+    Requests for the same site and sitemap are merged. A sitemap is refreshed
+    when no request came for NAVIGATION_AUTO_REFRESH_DELAY seconds, so many
+    changes in a short time cause only one refresh. Pages that change all the
+    time delay the refresh at most NAVIGATION_AUTO_REFRESH_MAX_DELAY seconds
+    after the first request.
+
+    If NAVIGATION_AUTO_REFRESH_THREAD is True (default), refreshes are done
+    by a background thread. Otherwise, they are done by the thread that adds
+    a request when the request ends, or by calling run_pending().
+    '''
+
+    def __init__(self):
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def get_delay(self):
+        return getattr(settings, 'NAVIGATION_AUTO_REFRESH_DELAY', 5)
+
+    def get_max_delay(self):
+        return getattr(settings, 'NAVIGATION_AUTO_REFRESH_MAX_DELAY', 60)
+
+    def use_thread(self):
+        return getattr(settings, 'NAVIGATION_AUTO_REFRESH_THREAD', True)
+
+    def add(self, site_id, slug):
+        ''' Requests refresh of menus of given site from sitemap with given slug. '''
+        with self._condition:
+            now = time.time()
+            first = self._pending.get((site_id, slug), (now, None))[0]
+            deadline = min(now + self.get_delay(), first + self.get_max_delay())
+            self._pending[(site_id, slug)] = (first, deadline)
+            self._condition.notify()
+
+        if self.use_thread():
+            self._start_thread()
+        else:
+            self.run_pending()
+
+    def get_pending(self):
+        ''' Returns list of (site_id, slug) waiting for refresh. '''
+        with self._condition:
+            return sorted(self._pending)
+
+    def run_pending(self, force=False):
+        ''' Refreshes sitemaps whose delay has passed, or all of them if force is True.
+
+        Returns number of refreshed sitemaps.
+        '''
+        with self._condition:
+            now = time.time()
+            due = sorted(key for key, (first, deadline) in self._pending.items() if force or deadline <= now)
+            for key in due:
+                del self._pending[key]
+
+        for site_id, slug in due:
+            refresh_sitemap_menus(site_id, slug)
+        return len(due)
+
+    def clear(self):
+        with self._condition:
+            self._pending.clear()
+
+    def _start_thread(self):
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='navigation-autorefresh')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        from .utils import _closing_connections
+
+        # refresh_menus() commits each menu itself and invalidates menus after
+        # the commit; an outer transaction would invalidate them too early
+        run_pending = _closing_connections(self.run_pending)
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                timeout = min(deadline for first, deadline in self._pending.values()) - time.time()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+
+            try:
+                run_pending()
+            except Exception:
+                logger.exception('Failed to refresh menus.')
+                time.sleep(self.get_delay())
+
+
+def refresh_sitemap_menus(site_id, slug):
+    ''' Refreshes all menus of the site from sitemap with given slug. '''
+    from .models import Menu, Sitemap
+    from .utils import ensure_sitemaps_discovered, refresh_menus
+
+    if site_id == settings.SITE_ID:
+        ensure_sitemaps_discovered()
+
+    sitemaps = Sitemap.objects.filter(site_id=site_id, slug=slug)
+    refresh_menus(Menu.objects.filter(site_id=site_id), sitemaps)
+
+
+def connect_listeners():
+    ''' Adds refresh requests to the queue when sitemaps change.
+
+    Signals listed in change_signals of sitemap classes are imported by their
+    dotted paths; sitemap classes are not instantiated. Sitemaps that override
+    add_listener() instead are instantiated to call it. It's done once per process.
+
+    Without the background thread, requests added while handling a request are
+    refreshed when the request ends.
+    '''
+    from django.utils.module_loading import import_by_path
+    from .registry import registry
+    from .sitemaps import AbstractSitemapInfo
+
+    with _connect_lock:
+        if _connected:
+            return
+        _connected.append(True)
+        request_finished.connect(_run_pending_on_request_finished, dispatch_uid='navigation_autorefresh_request_finished')
+
+        for cls in registry.get_classes():
+            if cls.change_signals:
+                for path in cls.change_signals:
+                    import_by_path(path).connect(_get_receiver(cls.slug), weak=False,
+                        dispatch_uid='navigation_autorefresh:%s:%s' % (cls.slug, path))
+            elif cls.add_listener.im_func is not AbstractSitemapInfo.add_listener.im_func:
+                registry.get_info(cls.slug).add_listener(lambda info: _request_refresh(info.site_id, info.slug))
+
+def connect_listeners_on_first_request():
+    ''' Connects listeners when the first request starts, after all apps are loaded.
+
+    Django 1.6 has no hook that is called after start up, and doing it on import
+    would load sitemaps and their models while the process starts.
+    '''
+    request_started.disconnect(dispatch_uid='navigation_connect_autorefresh')
+    if getattr(settings, 'NAVIGATION_AUTO_REFRESH', False):
+        connect_listeners()
+
+def _get_receiver(slug):
+    def receiver(sender, **kwargs):
+        _request_refresh(settings.SITE_ID, slug)
+    return receiver
+
+def _run_pending_on_request_finished(sender, **kwargs):
+    if not queue.use_thread():
+        try:
+            queue.run_pending(force=True)
+        except Exception:
+            logger.exception('Failed to refresh menus.')
+
+def _request_refresh(site_id, slug):
+    if getattr(settings, 'NAVIGATION_AUTO_REFRESH', False):
+        queue.add(site_id, slug)
+
+
+queue = RefreshQueue()
+
+_connected = []
+_connect_lock = threading.Lock()
@@ -0,0 +1,380 @@
+import hashlib
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache, get_cache
+
+
+VERSION_KEY = 'navigation:menu-version'
+# prefix of versions used when the cache can't keep the version
+_UNCACHED_PREFIX = 'uncached-'
+
+# stored in Django's cache for menus that don't exist
+_NO_MENU = ()
+
+_menus = {}
+_menus_lock = threading.Lock()
+_fill_locks = {}
+_missing_menus = {}
+_local = threading.local()
+_uncached_versions = itertools.count()
+
+_fragments = {}
+_fragments_version = [None]
+_fragments_lock = threading.Lock()
+_fragment_caches = {}
+
+
+def get_menu_version():
+    ''' Returns current version of all menus.
+
+    The version is kept in Django's cache so that all processes sharing
+    the cache see the same value. It starts from current time, so a version
+    lost by the cache (ex: evicted) is not used again. If the cache can't keep
+    it (ex: DummyCache), each call returns a new version, so nothing is reused.
+    '''
+    return _get_menu_version()[0]
+
+def _get_menu_version():
+    ''' Returns (version, True), or (new version, False) if the cache can't keep it. '''
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _new_version(), None)
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            return '%s%s-%s' % (_UNCACHED_PREFIX, _new_version(), next(_uncached_versions)), False
+    return version, True
+
+def _check_menu_version(version):
+    ''' Returns (version, kept) like _get_menu_version() for given version or current one. '''
+    if version is None:
+        return _get_menu_version()
+    return version, not unicode(version).startswith(_UNCACHED_PREFIX)
+
+def _new_version():
+    return int(time.time() * 1000)
+
+def invalidate_menus():
+    ''' Marks all cached menus as stale. Call it when menus change. '''
+    if getattr(_local, 'batch_depth', 0):
+        _local.batch_pending = True
+        return
+    
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, _new_version(), None)
+
+@contextmanager
+def batch_invalidation():
+    ''' Invalidates menus once at the end of the block, instead of after each change. '''
+    depth = getattr(_local, 'batch_depth', 0)
+    _local.batch_depth = depth + 1
+    try:
+        yield
+    finally:
+        _local.batch_depth = depth
+        if depth == 0 and getattr(_local, 'batch_pending', False):
+            _local.batch_pending = False
+            invalidate_menus()
+
+def is_cache_enabled():
+    return getattr(settings, 'NAVIGATION_MENU_CACHE', True)
+
+def get_cached_menu(name, version=None):
+    ''' Returns menu with given name for current site with items loaded.
+
+    Menus are kept in memory of the process until menu version changes.
+    Returned menu is shared between threads; do not modify it.
+    
+    Only one thread of the process loads a changed menu. Other threads use
+    the previous version until it's ready, or wait if there is none. Loaded
+    menu items are also stored in Django's cache for other processes. While
+    one process loads them, others use their previous version or wait.
+    
+    Pass version returned by get_menu_version() to avoid reading it again.
+    '''
+    return _get_cached_menu(name, {'name': name}, version)
+
+def get_cached_sitemap_menu(slug, version=None):
+    ''' Returns menu of sitemap with given slug; it's cached like get_cached_menu(). '''
+    return _get_cached_menu(('sitemap', slug), {'sitemap__slug': slug}, version)
+
+def prefetch_menus(names=(), sitemaps=(), version=None):
+    ''' Loads menus with given names and menus of given sitemaps at once.
+    
+    Menus are looked up in memory of the process first, then in Django's cache
+    with one request. Menus that are in neither are loaded with two queries,
+    instead of two queries for each menu, like get_cached_menu() does: names
+    that other threads or processes are loading are waited for or their previous
+    version is used. Names of menus that don't exist are cached too.
+    
+    Returns dict of found menus by name, or by ('sitemap', slug) for menus of sitemaps.
+    '''
+    from navigation.models import Menu
+    
+    lookups = [(name, {'name': name}) for name in names]
+    lookups += [(('sitemap', slug), {'sitemap__slug': slug}) for slug in sitemaps]
+    
+    version, kept = _check_menu_version(version) if is_cache_enabled() else (None, False)
+    if not kept:
+        found = _read_many_menu_data(lookups)
+        for menu, items in found.values():
+            menu._set_items(items)
+        return dict((name, data[0]) for name, data in found.items())
+    
+    site_id = Menu.current_objects.get_site_id()
+    
+    result = {}
+    uncached = []
+    for name, lookup in lookups:
+        entry = _menus.get((site_id, name))
+        if entry and entry[0] == version:
+            result[name] = entry[1]
+        elif _missing_menus.get((site_id, name)) != version:
+            uncached.append((name, lookup))
+    
+    data_keys = dict((name, get_menu_data_key(site_id, name, version)) for name, lookup in uncached)
+    cached = cache.get_many(data_keys.values()) if data_keys else {}
+    
+    found = {}
+    misses = []
+    for name, lookup in uncached:
+        data = cached.get(data_keys[name])
+        if data is None:
+            misses.append((name, lookup))
+        elif data:
+            found[name] = data
+        else:
+            _missing_menus[(site_id, name)] = version
+    
+    # only misses that no other thread or process is loading are read here
+    locked = []
+    others = []
+    timeout = getattr(settings, 'NAVIGATION_MENU_LOCK_TIMEOUT', 10)
+    for name, lookup in misses:
+        lock = _get_fill_lock((site_id, name))
+        if not lock.acquire(False):
+            others.append((name, lookup))
+        elif not cache.add(data_keys[name] + ':lock', 1, timeout):
+            lock.release()
+            others.append((name, lookup))
+        else:
+            locked.append((name, lookup, lock))
+    
+    try:
+        if locked:
+            loaded = _read_many_menu_data([(name, lookup) for name, lookup, lock in locked])
+            cache.set_many(dict((data_keys[name], loaded.get(name, _NO_MENU)) for name, lookup, lock in locked),
+                getattr(settings, 'NAVIGATION_MENU_DATA_TIMEOUT', 300))
+            found.update(loaded)
+            for name, lookup, lock in locked:
+                if name not in loaded:
+                    _missing_menus[(site_id, name)] = version
+    finally:
+        for name, lookup, lock in locked:
+            cache.delete(data_keys[name] + ':lock')
+            lock.release()
+    
+    for menu, items in found.values():
+        menu._set_items(items)
+    with _menus_lock:
+        for name, data in found.items():
+            _menus[(site_id, name)] = (version, data[0])
+            result[name] = data[0]
+    
+    for name, lookup in others:
+        try:
+            result[name] = _get_cached_menu(name, lookup, version)
+        except Menu.DoesNotExist:
+            pass
+    return result
+
+def _read_many_menu_data(lookups):
+    ''' Reads menus and their items with two queries.
+    
+    Returns dict of (menu, items) of found menus by names from lookups.
+    '''
+    from django.db.models import Q
+    from navigation.models import Menu, MenuItem
+    
+    query = Q(pk__in=[])
+    for name, lookup in lookups:
+        query |= Q(**lookup)
+    
+    menus = {}
+    for menu in Menu.current_objects.filter(query).select_related('sitemap'):
+        menus[menu.id] = (menu, [])
+    for item in MenuItem.objects.filter(menu__in=list(menus)).order_by('order'):
+        menus[item.menu_id][1].append(item)
+    
+    by_name = {}
+    for data in menus.values():
+        menu = data[0]
+        by_name[menu.name] = data
+        if menu.sitemap is not None:
+            by_name[('sitemap', menu.sitemap.slug)] = data
+    return dict((name, by_name[name]) for name, lookup in lookups if name in by_name)
+
+def _get_cached_menu(name, lookup, version=None):
+    from navigation.models import Menu
+
+    if not is_cache_enabled():
+        return Menu.current_objects.get(**lookup)
+
+    version, kept = _check_menu_version(version)
+    if not kept:
+        return Menu.current_objects.get(**lookup)
+
+    site_id = Menu.current_objects.get_site_id()
+    key = (site_id, name)
+
+    entry = _menus.get(key)
+    if entry and entry[0] == version:
+        return entry[1]
+    stale_menu = entry[1] if entry else None
+    
+    lock = _get_fill_lock(key)
+    if not lock.acquire(False):
+        if stale_menu is not None:
+            return stale_menu
+        lock.acquire()
+    
+    try:
+        entry = _menus.get(key)
+        if entry and entry[0] == version:
+            return entry[1]
+        
+        menu = _load_menu(site_id, name, lookup, version, stale_menu)
+        if menu is not stale_menu:
+            with _menus_lock:
+                _menus[key] = (version, menu)
+        return menu
+    finally:
+        lock.release()
+
+def get_menu_data_key(site_id, name, version):
+    ''' Returns cache key of items of the menu. '''
+    return get_fragment_key(version, 'menu-data', site_id, name)
+
+def _get_fill_lock(key):
+    with _menus_lock:
+        return _fill_locks.setdefault(key, threading.Lock())
+
+def _load_menu(site_id, name, lookup, version, stale_menu):
+    ''' Loads menu from Django's cache or from database.
+    
+    Returns stale_menu if another process is loading the menu.
+    '''
+    data_key = get_menu_data_key(site_id, name, version)
+    data = cache.get(data_key)
+    
+    if data is None:
+        lock_key = data_key + ':lock'
+        timeout = getattr(settings, 'NAVIGATION_MENU_LOCK_TIMEOUT', 10)
+        if cache.add(lock_key, 1, timeout):
+            try:
+                data = _read_menu_data(lookup)
+                cache.set(data_key, data or _NO_MENU, getattr(settings, 'NAVIGATION_MENU_DATA_TIMEOUT', 300))
+            finally:
+                cache.delete(lock_key)
+        elif stale_menu is not None:
+            return stale_menu
+        else:
+            data = _wait_for_menu_data(data_key, lock_key, timeout)
+            if data is None:
+                data = _read_menu_data(lookup)
+    
+    if not data:
+        from navigation.models import Menu
+        raise Menu.DoesNotExist('Menu matching %r does not exist.' % lookup)
+    menu, items = data
+    menu._set_items(items)
+    return menu
+
+def _read_menu_data(lookup):
+    ''' Returns (menu, items), or None if the menu doesn't exist. '''
+    from navigation.models import Menu
+    
+    try:
+        menu = Menu.current_objects.get(**lookup)
+    except Menu.DoesNotExist:
+        return None
+    return (menu, list(menu.menuitem_set.order_by('order').all()))
+
+def _wait_for_menu_data(data_key, lock_key, timeout):
+    ''' Waits until another process stores menu data or releases the lock. '''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(0.05)
+        data = cache.get(data_key)
+        if data is not None or cache.get(lock_key) is None:
+            return data
+    return None
+
+def clear_cached_menus():
+    ''' Removes all menus kept in memory of this process. '''
+    with _menus_lock:
+        _menus.clear()
+        _missing_menus.clear()
+
+def get_fragment_cache():
+    ''' Returns Django cache used for rendered menus or None if disabled.
+    
+    Set NAVIGATION_FRAGMENT_CACHE to True to use default cache, or to
+    name of cache from CACHES setting.
+    '''
+    alias = getattr(settings, 'NAVIGATION_FRAGMENT_CACHE', False)
+    if not alias:
+        return None
+    if alias is True:
+        alias = 'default'
+    if alias not in _fragment_caches:
+        _fragment_caches[alias] = get_cache(alias)
+    return _fragment_caches[alias]
+
+def get_fragment_key(version, *parts):
+    ''' Returns cache key for a rendered fragment. '''
+    raw = u'|'.join(unicode(p) for p in (version, ) + parts)
+    return 'navigation:fragment:%s' % hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+def get_cached_fragment(version, key):
+    ''' Returns rendered fragment or None.
+    
+    Fragments are looked up in memory of the process first, then in Django's cache.
+    '''
+    fragment_cache = get_fragment_cache()
+    if fragment_cache is None:
+        return None
+    
+    with _fragments_lock:
+        if _fragments_version[0] != version:
+            _fragments.clear()
+            _fragments_version[0] = version
+        html = _fragments.get(key)
+    
+    if html is None:
+        html = fragment_cache.get(key)
+        if html is not None:
+            _store_fragment(version, key, html)
+    return html
+
+def set_cached_fragment(version, key, html):
+    fragment_cache = get_fragment_cache()
+    if fragment_cache is None:
+        return
+    
+    fragment_cache.set(key, html, getattr(settings, 'NAVIGATION_FRAGMENT_CACHE_TIMEOUT', 300))
+    _store_fragment(version, key, html)
+
+def _store_fragment(version, key, html):
+    with _fragments_lock:
+        if _fragments_version[0] != version:
+            _fragments.clear()
+            _fragments_version[0] = version
+        if len(_fragments) >= getattr(settings, 'NAVIGATION_FRAGMENT_CACHE_SIZE', 1000):
+            _fragments.clear()
+        _fragments[key] = html
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = 'Creates sitemaps listed in NAVIGATION_SITEMAPS for current site.'
+    
+    def handle_noargs(self, **options):
+        from navigation.models import Sitemap
+        from navigation.utils import discover_sitemaps
+        
+        discover_sitemaps()
+        self.stdout.write('Sitemaps: %s' % ', '.join(Sitemap.current_objects.values_list('slug', flat=True)))
@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = 'Refreshes menu items from sitemaps.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--site', action='append', dest='sites', type='int', default=[],
+            help='Id of site to refresh. Use it many times to refresh many sites. Default is current site.'),
+        make_option('--menu', action='append', dest='menus', default=[],
+            help='Name of menu to refresh. Use it many times to refresh many menus. Default is all menus.'),
+        make_option('--sitemap', action='append', dest='sitemaps', default=[],
+            help='Slug of sitemap to refresh from. Use it many times to use many sitemaps. Default is all sitemaps.'),
+        make_option('--workers', action='store', dest='workers', type='int', default=None,
+            help='Number of menus refreshed at the same time. Default is NAVIGATION_REFRESH_WORKERS.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Print changes without saving them.'),
+    )
+
+    def handle_noargs(self, **options):
+        from navigation.models import Menu, Sitemap
+        from navigation.utils import StageTimer, refresh_menus
+
+        timer = StageTimer()
+        verbosity = int(options.get('verbosity', 1))
+
+        for site_id in options['sites'] or [settings.SITE_ID]:
+            menus = Menu.objects.filter(site_id=site_id)
+            if options['menus']:
+                menus = menus.filter(name__in=options['menus'])
+            sitemaps = Sitemap.objects.filter(site_id=site_id)
+            if options['sitemaps']:
+                sitemaps = sitemaps.filter(slug__in=options['sitemaps'])
+
+            diffs = refresh_menus(menus, sitemaps, options['workers'], options['dry_run'], timer)
+
+            for diff in diffs:
+                self.stdout.write('Site %s, menu "%s" from %s: %d new, %d changed, %d deleted' % (
+                    site_id, diff.menu.name, diff.sitemap.slug,
+                    len(diff.new_items), len(diff.changed_items), len(diff.deleted_items)))
+                if options['dry_run'] or verbosity > 1:
+                    for line in diff.describe():
+                        self.stdout.write(u'  ' + line)
+
+        for stage in ('fetch', 'diff', 'write', 'reorder'):
+            self.stdout.write('%s: %.3fs' % (stage, timer.totals.get(stage, 0)))
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = 'Replaces ids of menu items created by django-navigation 0.2 and older.'
+    
+    def handle_noargs(self, **options):
+        from navigation.utils import upgrade_sitemap_item_ids
+        
+        count = upgrade_sitemap_item_ids()
+        self.stdout.write('Updated %d menu items.' % count)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'MenuItem.depth'
+        db.add_column('navigation_menuitem', 'depth',
+                      self.gf('django.db.models.fields.IntegerField')(default=0),
+                      keep_default=False)
+
+        # Adding field 'MenuItem.lft'
+        db.add_column('navigation_menuitem', 'lft',
+                      self.gf('django.db.models.fields.IntegerField')(default=0),
+                      keep_default=False)
+
+        # Adding field 'MenuItem.rgt'
+        db.add_column('navigation_menuitem', 'rgt',
+                      self.gf('django.db.models.fields.IntegerField')(default=0),
+                      keep_default=False)
+
+        # Adding index on 'MenuItem', fields ['menu', 'lft', 'rgt']
+        db.create_index('navigation_menuitem', ['menu_id', 'lft', 'rgt'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'MenuItem', fields ['menu', 'lft', 'rgt']
+        db.delete_index('navigation_menuitem', ['menu_id', 'lft', 'rgt'])
+
+        # Deleting field 'MenuItem.depth'
+        db.delete_column('navigation_menuitem', 'depth')
+
+        # Deleting field 'MenuItem.lft'
+        db.delete_column('navigation_menuitem', 'lft')
+
+        # Deleting field 'MenuItem.rgt'
+        db.delete_column('navigation_menuitem', 'rgt')
+
+
+    models = {
+        'navigation.menu': {
+            'Meta': {'ordering': "['name']", 'object_name': 'Menu'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sites.Site']"}),
+            'sitemap': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'menus'", 'null': 'True', 'to': "orm['navigation.Sitemap']"})
+        },
+        'navigation.menuitem': {
+            'Meta': {'ordering': "['order']", 'object_name': 'MenuItem', 'index_together': "[['menu', 'lft', 'rgt']]"},
+            'depth': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lft': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'menu': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['navigation.Menu']"}),
+            'my_parent': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'db_column': "'parent_id'", 'to': "orm['navigation.MenuItem']"}),
+            'order': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'rgt': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'sitemap': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['navigation.Sitemap']", 'null': 'True'}),
+            'sitemap_item_id': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True'}),
+            'sitemap_item_status': ('django.db.models.fields.CharField', [], {'max_length': '16', 'null': 'True'}),
+            'sitemap_item_title': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'auto'", 'max_length': '16'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'url': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'navigation.sitemap': {
+            'Meta': {'object_name': 'Sitemap'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sites.Site']"}),
+            'slug': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'sites.site': {
+            'Meta': {'ordering': "('domain',)", 'object_name': 'Site', 'db_table': "'django_site'"},
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['navigation']
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from south.v2 import DataMigration
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        # ids are computed by sitemap classes, so current models are used
+        from navigation.cache import invalidate_menus
+        from navigation.utils import _upgrade_sitemap_item_ids
+        _upgrade_sitemap_item_ids()
+        invalidate_menus()
+
+    def backwards(self, orm):
+        # old ids are not restored
+        pass
+
+    models = {
+        'navigation.menu': {
+            'Meta': {'ordering': "['name']", 'object_name': 'Menu'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sites.Site']"}),
+            'sitemap': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'menus'", 'null': 'True', 'to': "orm['navigation.Sitemap']"})
+        },
+        'navigation.menuitem': {
+            'Meta': {'ordering': "['order']", 'object_name': 'MenuItem', 'index_together': "[['menu', 'lft', 'rgt']]"},
+            'depth': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lft': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'menu': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['navigation.Menu']"}),
+            'my_parent': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'db_column': "'parent_id'", 'to': "orm['navigation.MenuItem']"}),
+            'order': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'rgt': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'sitemap': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['navigation.Sitemap']", 'null': 'True'}),
+            'sitemap_item_id': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True'}),
+            'sitemap_item_status': ('django.db.models.fields.CharField', [], {'max_length': '16', 'null': 'True'}),
+            'sitemap_item_title': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'auto'", 'max_length': '16'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'url': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'navigation.sitemap': {
+            'Meta': {'object_name': 'Sitemap'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sites.Site']"}),
+            'slug': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'sites.site': {
+            'Meta': {'ordering': "('domain',)", 'object_name': 'Site', 'db_table': "'django_site'"},
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['navigation']
@@ -1,6 +1,8 @@
 
 from django.core.exceptions import  ObjectDoesNotExist
+from django.core.signals import request_started
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext as _
 
 from navigation.managers import MenuManager, SitemapManager
@@ -17,24 +19,16 @@ class Sitemap(models.Model):
         from .utils import get_sitemap_info_with_slug
         
         if not hasattr(self, '_info'):
-            self._info = get_sitemap_info_with_slug(self.slug)
+            self._info = get_sitemap_info_with_slug(self.slug, self.site_id)
             
         if self._info is None:
             raise Exception("Sitemap is not available.")
         return self._info
     
     def get_items(self):
+        ''' Returns dict with information about each item of the sitemap. '''
         info = self._get_info()
-        
-        for item in info.items():
-            # get info about each item
-            data = {}
-            for attr_name in dir(info):
-                if attr_name.startswith('item_'):
-                    key = attr_name[5:]
-                    data[ key ] = getattr(info, attr_name)(item)
-            # return it
-            yield data
+        return info.items_data()
             
     def has_item_parent(self):
         info = self._get_info()
@@ -50,7 +44,7 @@ class Sitemap(models.Model):
         from .utils import get_sitemap_info_with_slug
         
         try:
-            info = get_sitemap_info_with_slug(self.slug)
+            info = get_sitemap_info_with_slug(self.slug, self.site_id)
             if info:
                 return True
             else:
@@ -86,23 +80,23 @@ class Menu(models.Model):
     def list_top_items(self):
         ''' Return all top-level items '''
         self._load_items()
-        return [i for i in self.all_items if i.my_parent_id == None]
+        return list(self._items_by_parent.get(None, []))
         
     def find_items(self, **kwargs):
         ''' Searches for items '''
         self._load_items()
         
         if 'id' in kwargs:
-            return [i for i in self.all_items if i.id == kwargs['id']]
+            return self._find_items_by_id(kwargs['id'])
         if 'pk' in kwargs:
-            return [i for i in self.all_items if i.pk == kwargs['pk']]
+            return self._find_items_by_id(kwargs['pk'])
         if 'url' in kwargs:
-            return [i for i in self.all_items if i.url == kwargs['url']]
+            return list(self._items_by_url.get(kwargs['url'], []))
         if 'parent' in kwargs:
             if kwargs['parent'] == None:
-                return [i for i in self.all_items if i.my_parent_id == None]
+                return list(self._items_by_parent.get(None, []))
             else:
-                return [i for i in self.all_items if i.my_parent_id == kwargs['parent'].id]
+                return list(self._items_by_parent.get(kwargs['parent'].id, []))
     
     def get_item(self, **kwargs):
         ''' Returns specific item '''
@@ -111,38 +105,145 @@ class Menu(models.Model):
         except IndexError:
             raise ObjectDoesNotExist()
     
+    def get_trail(self, url, match_prefix=False):
+        ''' Returns item with given URL and all its ancestors.
+        
+        The tuple starts with the item and ends with top-level item. It's empty 
+        if there is no such item. URL with and without trailing slash is the same.
+        
+        If match_prefix is True and no item has given URL, the item with 
+        the longest path that is a prefix of the URL is used. Ex: "/blog/" 
+        for "/blog/2014/post/". Top-level "/" is matched only exactly.
+        '''
+        from navigation.utils import normalize_url
+        
+        self._load_items()
+        
+        if self._trails is None:
+            self._build_trails()
+        
+        trail = self._trails.get(url)
+        if trail is None:
+            trail = self._normalized_trails.get(normalize_url(url))
+        if trail is None and match_prefix:
+            trail = self._find_trail_by_prefix(url)
+        return trail or ()
+    
+    def _find_trail_by_prefix(self, url):
+        from navigation.utils import split_url_path
+        
+        trail = None
+        node = self._url_trie
+        for segment in split_url_path(url) or []:
+            node = node[1].get(segment)
+            if node is None:
+                break
+            if node[0] is not None:
+                trail = node[0]
+        return trail
+    
+    def _build_trails(self):
+        from navigation.utils import normalize_url, split_url_path
+        
+        trails_by_id = {}
+        def get_item_trail(item):
+            # walk up until a known trail is found
+            path = []
+            while item is not None and item.id not in trails_by_id:
+                path.append(item)
+                item = self._items_by_id.get(item.my_parent_id)
+                if item in path:
+                    item = None
+            trail = trails_by_id[item.id] if item is not None else ()
+            for i in reversed(path):
+                trail = (i, ) + trail
+                trails_by_id[i.id] = trail
+            return trail
+        
+        trails = {}
+        normalized_trails = {}
+        url_trie = [None, {}] # each node is [trail, {segment: node}]
+        for item in self.all_items:
+            trail = get_item_trail(item)
+            trails.setdefault(item.url, trail)
+            normalized_trails.setdefault(normalize_url(item.url), trail)
+            
+            segments = split_url_path(item.url)
+            if segments:
+                node = url_trie
+                for segment in segments:
+                    node = node[1].setdefault(segment, [None, {}])
+                if node[0] is None:
+                    node[0] = trail
+        
+        self._normalized_trails = normalized_trails
+        self._url_trie = url_trie
+        self._trails = trails
+    
+    def _find_items_by_id(self, item_id):
+        try:
+            return [self._items_by_id[item_id]]
+        except (KeyError, TypeError):
+            return []
+    
     def _load_items(self):
         if self.all_items == None:
-            self.all_items = []
-            
-            for i in self.menuitem_set.order_by('order').all():
-                i.menu = self
-                self.all_items.append(i)
+            self._set_items(self.menuitem_set.order_by('order').all())
+    
+    def _set_items(self, items):
+        ''' Stores items and builds lookup indexes.
+        
+        Items must be sorted by "order". Lists of children keep that order.
+        '''
+        self.all_items = []
+        self._trails = None
+        self._items_by_id = {}
+        self._items_by_url = {}
+        self._items_by_parent = {}
+        
+        for i in items:
+            i.menu = self
+            self.all_items.append(i)
+            self._items_by_id[i.id] = i
+            self._items_by_url.setdefault(i.url, []).append(i)
+            self._items_by_parent.setdefault(i.my_parent_id, []).append(i)
     
     def clean_item_order(self):
+        ''' Numbers items in depth-first order and updates their tree columns.
+        
+        Call it after changing items. Only items that changed are saved, with
+        one batched update for each chunk of items.
+        '''
+        from navigation.cache import invalidate_menus
+        from navigation.utils import get_tree_positions, update_items
+        
         self.all_items = None
         
-        # sort items in depth-first order
-        def get_sorted_descendents(all_items, parent):
-            for item in all_items:
-                if item.my_parent_id == parent.id:
-                    yield item
-                    for descendent in get_sorted_descendents(all_items, item):
-                        yield descendent
-            pass
-        def get_sorted(all_items):
-            all_items = list(all_items)
-            for item in all_items:
-                if item.my_parent_id == None:
-                    yield item
-                    for descendent in get_sorted_descendents(all_items, item):
-                        yield descendent
-            pass
-
-        all_items = self.menuitem_set.order_by('order').all()
-        for index, item in enumerate(get_sorted(all_items)):
-            item.order = index
-            item.save()
+        all_items = list(self.menuitem_set.order_by('order').all())
+        index_by_id = dict((item.id, index) for index, item in enumerate(all_items))
+        
+        # items with missing parent are not sorted
+        parents = []
+        for item in all_items:
+            if item.my_parent_id == None:
+                parents.append(None)
+            else:
+                parents.append(index_by_id.get(item.my_parent_id, -1))
+        
+        changed_items = []
+        positions = get_tree_positions(parents, range(len(all_items)))
+        for order, (index, depth, lft, rgt) in enumerate(positions):
+            item = all_items[index]
+            if (item.order, item.depth, item.lft, item.rgt) != (order, depth, lft, rgt):
+                item.order = order
+                item.depth = depth
+                item.lft = lft
+                item.rgt = rgt
+                changed_items.append(item)
+        
+        if changed_items:
+            update_items(changed_items, ('order', 'depth', 'lft', 'rgt'))
+            invalidate_menus()
         
     
     def save(self, *args, **kwargs):
@@ -170,6 +271,11 @@ class MenuItem(models.Model):
     order = models.IntegerField(default=1)
     status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='auto')
     
+    # position in the tree; updated by Menu.clean_item_order()
+    depth = models.IntegerField(default=0, editable=False)
+    lft = models.IntegerField(default=0, editable=False)
+    rgt = models.IntegerField(default=0, editable=False)
+    
     # id to the underlying object, as returned by sitemap
     sitemap = models.ForeignKey(Sitemap, null=True, editable=False)
     sitemap_item_id = models.CharField(max_length=255, null=True, editable=False)
@@ -178,6 +284,9 @@ class MenuItem(models.Model):
     
     class Meta:
         ordering = ['order']
+        index_together = [
+            ['menu', 'lft', 'rgt'],
+        ]
                 
     def is_enabled(self):
         if self.status == 'enabled':
@@ -198,8 +307,22 @@ class MenuItem(models.Model):
     def list_active_children(self):
         return [c for c in self.list_children() if c.is_enabled()]
     
+    def query_descendants(self):
+        ''' Returns queryset of all descendants, in depth-first order. 
+        
+        It doesn't need the menu to be loaded. 
+        '''
+        return MenuItem.objects.filter(menu_id=self.menu_id, lft__gt=self.lft, rgt__lt=self.rgt).order_by('lft')
+    
+    def query_ancestors(self):
+        ''' Returns queryset of all ancestors, starting with top-level item. 
+        
+        It doesn't need the menu to be loaded. 
+        '''
+        return MenuItem.objects.filter(menu_id=self.menu_id, lft__lt=self.lft, rgt__gt=self.rgt).order_by('lft')
+    
     def get_parent(self):
-        if self.my_parent == None:
+        if self.my_parent_id == None:
             return None
         else:
             return self.menu.get_item(id=self.my_parent_id)
@@ -231,3 +354,18 @@ class MenuItem(models.Model):
     children = property(list_children)
     active_children = property(list_active_children)
     parent = property(get_parent, set_parent)
+
+
+def _invalidate_menus(sender, **kwargs):
+    from navigation.cache import invalidate_menus
+    invalidate_menus()
+
+for model in (Menu, MenuItem):
+    post_save.connect(_invalidate_menus, sender=model, dispatch_uid='navigation_invalidate_menus')
+    post_delete.connect(_invalidate_menus, sender=model, dispatch_uid='navigation_invalidate_menus')
+
+def _connect_autorefresh(sender, **kwargs):
+    from navigation.autorefresh import connect_listeners_on_first_request
+    connect_listeners_on_first_request()
+
+request_started.connect(_connect_autorefresh, dispatch_uid='navigation_connect_autorefresh')
@@ -0,0 +1,105 @@
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test.signals import setting_changed
+from django.utils.importlib import import_module
+
+
+class SitemapRegistry(object):
+    ''' Sitemap classes listed in NAVIGATION_SITEMAPS.
+
+    Classes are loaded once per process, when they are first needed.
+    SitemapInfo objects are created once for each site.
+    Call reset() after NAVIGATION_SITEMAPS changes.
+    
+    discovered_sites -- ids of sites that have Sitemap objects for all sitemaps
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._classes = None
+            self._classes_by_slug = None
+            self._instances = {}
+            self.discovered_sites = set()
+
+    def get_classes(self):
+        ''' Returns sitemap classes in order they are listed in settings. '''
+        if self._classes is None:
+            self._load()
+        return self._classes
+
+    def get_class(self, slug):
+        ''' Returns sitemap class with given slug or None. '''
+        if self._classes_by_slug is None:
+            self._load()
+        return self._classes_by_slug.get(slug)
+
+    def get_info(self, slug, site_id=None):
+        ''' Returns SitemapInfo object with given slug or None. '''
+        cls = self.get_class(slug)
+        if cls is None:
+            return None
+        return self._get_instance(cls, site_id)
+
+    def get_info_list(self, site_id=None):
+        ''' Returns SitemapInfo objects for all sitemaps. '''
+        return [self._get_instance(cls, site_id) for cls in self.get_classes()]
+
+    def _get_instance(self, cls, site_id):
+        if site_id is None:
+            site_id = settings.SITE_ID
+
+        key = (cls.slug, site_id)
+        info = self._instances.get(key)
+        if info is None:
+            with self._lock:
+                info = self._instances.get(key)
+                if info is None:
+                    info = cls(site_id)
+                    self._instances[key] = info
+        return info
+
+    def _load(self):
+        with self._lock:
+            if self._classes is not None:
+                return
+
+            try:
+                settings_list = settings.NAVIGATION_SITEMAPS
+            except AttributeError:
+                raise ImproperlyConfigured('Add NAVIGATION_SITEMAPS to your settings.py file.')
+
+            classes = []
+            classes_by_slug = {}
+            for full_name in settings_list:
+                module_name, class_name = full_name.rsplit('.', 1)
+
+                try:
+                    module = import_module(module_name)
+                    cls = getattr(module, class_name)
+                except (ImportError, AttributeError):
+                    raise ImproperlyConfigured('Failed to load sitemap info: %s' % full_name)
+
+                if cls.slug in classes_by_slug:
+                    raise ImproperlyConfigured("Multiple sitemaps are registered with the same slug: " + cls.slug)
+
+                classes.append(cls)
+                classes_by_slug[cls.slug] = cls
+
+            self._classes_by_slug = classes_by_slug
+            self._classes = classes
+
+
+registry = SitemapRegistry()
+
+
+def _reset_registry(setting, **kwargs):
+    if setting in ('NAVIGATION_SITEMAPS', 'SITE_ID'):
+        registry.reset()
+
+setting_changed.connect(_reset_registry, dispatch_uid='navigation_reset_registry')
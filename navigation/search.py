@@ -0,0 +1,109 @@
+import re
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_indexes = {}
+_listening = set()
+
+
+class SitemapSearchIndex(object):
+    ''' Index of sitemap items for searching by title and URL.
+
+    Lowercase titles and URLs are kept sorted, so prefix search is a binary search.
+    Suffixes of words of titles and URLs are indexed for finding items by part
+    of a word.
+    '''
+
+    def __init__(self, items):
+        self.items = list(items)
+        self._titles = []
+        self._locations = []
+        self._suffixes = {}
+
+        for index, item in enumerate(self.items):
+            title = (item.get('title') or '').lower()
+            location = (item.get('location') or '').lower()
+            self._titles.append(title)
+            self._locations.append(location)
+
+            for token in TOKEN_RE.findall(title) + TOKEN_RE.findall(location):
+                for start in range(len(token)):
+                    self._suffixes.setdefault(token[start:], set()).add(index)
+
+        self._sorted_titles = sorted((title, index) for index, title in enumerate(self._titles))
+        self._sorted_locations = sorted((location, index) for index, location in enumerate(self._locations))
+        self._sorted_suffixes = sorted(self._suffixes)
+
+    def find_by_url(self, url):
+        ''' Returns items with URL starting with given text. '''
+        return [self.items[i] for i in self._find_prefix(self._sorted_locations, url.lower())]
+
+    def find_by_term(self, term):
+        ''' Returns items with title or URL starting with given text.
+
+        If there are none, returns items with title or URL containing given text.
+        '''
+        term = term.lower()
+
+        indexes = set(self._find_prefix(self._sorted_titles, term))
+        indexes.update(self._find_prefix(self._sorted_locations, term))
+        indexes.update(self._find_prefix(self._sorted_locations, '/' + term))
+
+        if not indexes:
+            indexes = self._find_substring(term)
+
+        return [self.items[i] for i in sorted(indexes)]
+
+    def _find_prefix(self, sorted_keys, prefix):
+        position = bisect_left(sorted_keys, (prefix, ))
+        while position < len(sorted_keys) and sorted_keys[position][0].startswith(prefix):
+            yield sorted_keys[position][1]
+            position += 1
+
+    def _find_substring(self, term):
+        match = TOKEN_RE.match(term)
+        if match is None or match.end() != len(term):
+            # the term contains many words or other characters
+            return set(i for i in range(len(self.items)) if term in self._titles[i] or term in self._locations[i])
+
+        # a part of a word is the start of a suffix of the word
+        indexes = set()
+        position = bisect_left(self._sorted_suffixes, term)
+        while position < len(self._sorted_suffixes) and self._sorted_suffixes[position].startswith(term):
+            indexes.update(self._suffixes[self._sorted_suffixes[position]])
+            position += 1
+        return indexes
+
+
+def get_search_index(sitemap):
+    ''' Returns search index of given Sitemap.
+
+    The index is rebuilt when the sitemap notifies about changes, when
+    menus are refreshed, or after NAVIGATION_SEARCH_INDEX_TIMEOUT seconds.
+    '''
+    from navigation.cache import get_menu_version
+
+    key = (sitemap.site_id, sitemap.slug)
+    version = get_menu_version()
+    timeout = getattr(settings, 'NAVIGATION_SEARCH_INDEX_TIMEOUT', 300)
+
+    entry = _indexes.get(key)
+    if entry and entry[0] == version and entry[1] + timeout > time.time():
+        return entry[2]
+
+    info = sitemap._get_info()
+    if key not in _listening:
+        _listening.add(key)
+        info.add_listener(lambda info: invalidate_search_index(sitemap.site_id, info.slug))
+
+    index = SitemapSearchIndex(sitemap.get_items())
+    _indexes[key] = (version, time.time(), index)
+    return index
+
+def invalidate_search_index(site_id, slug):
+    _indexes.pop((site_id, slug), None)
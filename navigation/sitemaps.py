@@ -1,3 +1,10 @@
+import hashlib
+
+from django.db import models
+from django.utils.encoding import force_bytes
+from django.utils.translation import pgettext
+
+
 
 class AbstractSitemapInfo(object):
     ''' Represents a collection of pages that can be displayed in navigation.
@@ -13,8 +20,17 @@ class AbstractSitemapInfo(object):
     - item_enabled - if the page is currently enabled
     - item_parent - URL of the parent page
     - item_order - number use for sorting of pages 
+    - items_data - data of all pages at once; it's faster for large sitemaps
+    - change_signals - dotted paths of signals sent when pages change
      '''
     
+    _item_attribute_names = {}
+    
+    change_signals = ()
+    
+    # number of rows loaded at once by iterate_items()
+    chunk_size = 1000
+    
     def __init__(self, site_id):
         self.site_id = site_id
         
@@ -22,6 +38,62 @@ class AbstractSitemapInfo(object):
         ''' Items of the sitemap '''
         return []
     
+    def items_data(self):
+        ''' Returns information about each item as a dict. 
+        
+        Keys are names of "item_" methods without the prefix, ex: "location", "title".
+        Subclasses may override it to load data in bulk, ex: from values() queryset.
+        '''
+        extract = self.get_item_extractor()
+        for item in self.items():
+            yield extract(item)
+    
+    def get_item_extractor(self):
+        ''' Returns function that converts item to a dict. '''
+        methods = [(name[5:], getattr(self, name)) for name in self._get_item_attribute_names()]
+        
+        def extract(item):
+            return dict((key, method(item)) for key, method in methods)
+        return extract
+    
+    def iterate_items(self, queryset, fields=None):
+        ''' Yields objects of the queryset, loading chunk_size rows at a time.
+        
+        Rows are read in order of primary key. If fields are given, only 
+        those columns are loaded and objects are created from them.
+        '''
+        model = queryset.model
+        queryset = queryset.order_by('pk')
+        if fields:
+            queryset = queryset.values('pk', *fields)
+        
+        last_pk = None
+        while True:
+            if last_pk is None:
+                chunk = list(queryset[:self.chunk_size])
+            else:
+                chunk = list(queryset.filter(pk__gt=last_pk)[:self.chunk_size])
+            
+            for row in chunk:
+                if fields:
+                    last_pk = row.pop('pk')
+                    yield model(pk=last_pk, **row)
+                else:
+                    last_pk = row.pk
+                    yield row
+            
+            if len(chunk) < self.chunk_size:
+                break
+    
+    @classmethod
+    def _get_item_attribute_names(cls):
+        ''' Names of "item_" methods; found once per class. '''
+        names = AbstractSitemapInfo._item_attribute_names.get(cls)
+        if names is None:
+            names = tuple(name for name in dir(cls) if name.startswith('item_'))
+            AbstractSitemapInfo._item_attribute_names[cls] = names
+        return names
+    
     def item_location(self, item):
         ''' URL for the item '''
         try:
@@ -36,14 +108,20 @@ class AbstractSitemapInfo(object):
     def item_uuid(self, item):
         ''' ID for the item. 
         Must be unique within the sitemap. Should be based on ID of underlying object.
-        It can be a hexadecimal hash value, ex: SHA-512, MD.
-        see:
-        - hashlib.sha224
+        For models it is "app_label.model_name:pk", ex: "flatpages.flatpage:12".
+        Otherwise it's based on MD5 hash of item location.
         
         If it is a string, it must be not longer than 255 characters.'''
         
-        import hashlib
-        from django.db import models
+        if isinstance(item, models.Model):
+            opts = item._meta.concrete_model._meta
+            return '%s.%s:%s' % (opts.app_label, opts.model_name, item.pk)
+        else:
+            return 'url:%s' % hashlib.md5(force_bytes(self.item_location(item))).hexdigest()
+    
+    def legacy_uuid(self, item):
+        ''' ID for the item used by version 0.2 and older. 
+        It's used to upgrade existing menu items. '''
         
         if isinstance(item, models.Model):
             name = '/model/%s/%s' % (item.__class__.__name__, item.pk)
@@ -56,8 +134,16 @@ class AbstractSitemapInfo(object):
         return True       
     
     def add_listener(self, callback):
-        ''' Funcation callack should be called when sitemap changes. '''
-        pass
+        ''' Funcation callack should be called when sitemap changes. 
+        
+        By default, it's called when any of change_signals is sent.
+        '''
+        from django.utils.module_loading import import_by_path
+        
+        def receiver(sender, **kwargs):
+            callback(self)
+        for path in self.change_signals:
+            import_by_path(path).connect(receiver, weak=False)
     
     def __unicode__(self):
         return pgettext('navigation', self.slug)
@@ -78,36 +164,67 @@ class FlatPageSitemapInfo(AbstractSitemapInfo):
         
     def item_title(self, item):
         return item.title
+    
+    def items_data(self):
+        ''' Loads pages in chunks without their content. '''
+        extract = self.get_item_extractor()
+        for item in self.iterate_items(self.items(), ('url', 'title')):
+            yield extract(item)
 
     
 class CMSSitemapInfo(AbstractSitemapInfo):
     ''' Sitemap for Django CMS pages. '''
     
     slug = 'cms-pages'
+    change_signals = ('cms.signals.post_publish', )
     
     def items(self):
         from cms.models import Page
         return Page.objects.public()
     
+    def items_data(self):
+        ''' Loads all pages and their titles in two queries. 
+        
+        Parents are found among loaded pages. 
+        '''
+        from cms.models import Title
+        
+        pages = list(self.items())
+        pages_by_id = dict((page.id, page) for page in pages)
+        
+        # the same cache is filled by django-cms when it builds menus
+        for page in pages:
+            page.title_cache = {}
+        for title in Title.objects.filter(page__in=self.items()):
+            page = pages_by_id.get(title.page_id)
+            if page is not None:
+                page.title_cache[title.language] = title
+        
+        for page in pages:
+            page._navigation_parent = pages_by_id.get(page.parent_id)
+        
+        extract = self.get_item_extractor()
+        for page in pages:
+            yield extract(page)
+    
+    def item_location(self, item):
+        ''' URL for the page; it's computed once for each page object. '''
+        if not hasattr(item, '_navigation_location'):
+            item._navigation_location = item.get_absolute_url()
+        return item._navigation_location
+    
     def item_parent(self, item):
-        if item.parent:
-            return self.item_location( item.parent )
+        if item.parent_id:
+            parent = getattr(item, '_navigation_parent', None) or item.parent
+            return self.item_location( parent )
         else:
             return None
     
     def item_order(self, item):
-        if item.parent:
+        if item.parent_id:
             return item.lft
         else:
             return item.tree_id
         
     def item_enabled(self, item):
         return item.is_published(None) and item.in_navigation
-    
-    def add_listener(self, callback):
-        ''' Funcation callack should be called when sitemap changes. '''
-        import cms.signals as cms_signals
-        def receiver(sender, **kwargs):
-            callback(self)
-        cms_signals.post_publish.connect(receiver, weak=False)
-
@@ -0,0 +1,54 @@
+from navigation.cache import get_cached_menu, get_cached_sitemap_menu
+
+
+class NavigationState(object):
+    ''' Menus and current items found while rendering one page.
+
+    It's shared by all navigation tags of the page, so that each menu is
+    looked up and each current item is found only once. Call set_version()
+    with current menu version to forget menus that changed.
+    '''
+
+    def __init__(self):
+        self.version = None
+        self.menus = {}
+        self._trails = {}
+
+    def set_version(self, version):
+        if version != self.version:
+            self.version = version
+            self.menus = {}
+            self._trails = {}
+
+    def get_menu(self, name):
+        ''' Returns menu with given name with items loaded. '''
+        if name not in self.menus:
+            self.menus[name] = get_cached_menu(name, self.version)
+        return self.menus[name]
+
+    def get_sitemap_menu(self, slug):
+        ''' Returns menu of sitemap with given slug with items loaded. '''
+        key = ('sitemap', slug)
+        if key not in self.menus:
+            self.menus[key] = get_cached_sitemap_menu(slug, self.version)
+        return self.menus[key]
+
+    def add_menus(self, menus):
+        ''' Adds menus loaded by navigation.cache.prefetch_menus(). '''
+        self.menus.update(menus)
+
+    def get_trail(self, menu, url, match_prefix=False):
+        ''' Returns current item and its ancestors; see Menu.get_trail(). '''
+        key = (menu.id, url, match_prefix)
+        if key not in self._trails:
+            self._trails[key] = menu.get_trail(url, match_prefix)
+        return self._trails[key]
+
+
+def get_request_state(request):
+    ''' Returns NavigationState of the request. '''
+    state = getattr(request, 'navigation_state', None)
+    if state is None:
+        state = NavigationState()
+        request.navigation_state = state
+    return state
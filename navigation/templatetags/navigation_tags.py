@@ -5,16 +5,18 @@ from django import template
 from django.core.exceptions import ObjectDoesNotExist
 from django.template.loader import get_template
 from django.template.context import Context as DjangoTemplateContext
-from django.utils.translation import pgettext
+from django.utils.translation import get_language, pgettext
 
+from navigation.cache import get_cached_menu, get_cached_sitemap_menu, prefetch_menus, get_menu_version, get_fragment_cache, get_fragment_key, get_cached_fragment, set_cached_fragment
 from navigation.models import Sitemap, Menu, MenuItem
+from navigation.state import NavigationState, get_request_state
 
 
 register = template.Library()
 
 
 @register.simple_tag(takes_context=True)
-def show_navigation_menu(context, menu, root=None, template='navigation/menu.html', request_path=None):
+def show_navigation_menu(context, menu, root=None, template='navigation/menu.html', request_path=None, match_prefix=False):
 	""" Displays a navigation menu with given name 
 	
 	Passes the following information to template:
@@ -31,13 +33,20 @@ def show_navigation_menu(context, menu, root=None, template='navigation/menu.htm
 	menu -- name of the menu or menu item
 	root -- url of the root menu item
 	style -- style of the menu
+	match_prefix -- if True, current item is the one with the longest URL that is a prefix of current URL
+	
+	If NAVIGATION_FRAGMENT_CACHE is set, rendered top-level menus are cached.
 	"""
+	
+	state = get_navigation_state(context)
+	version = state.version
 
 	# get the menu
 	try:
-		data = get_navigation_menu(menu, root)
+		data = get_navigation_menu(menu, root, state)
 	except ObjectDoesNotExist:
 		return show_missing_menu(context, menu, 'navigation/menu-missing.html')
+	data['navigation_state'] = state
 	
 	if isinstance(context, Context):
 		data['depth'] = context['depth'] + 1
@@ -67,13 +76,24 @@ def show_navigation_menu(context, menu, root=None, template='navigation/menu.htm
 			the_path = context['request'].path
 		
 		if the_path != None:
-			for k, v in get_current_items(data['menu'], the_path).items():
+			for k, v in get_current_items(data['menu'], the_path, match_prefix, state).items():
 				data[k] = v
+		
+		# use cached menu if possible
+		if get_fragment_cache() is not None:
+			current_item_id = data['current_item'].id if data['current_item'] else None
+			parent_id = data['parent'].id if data['parent'] else None
+			key = get_fragment_key(version, 'menu', data['menu'].id, parent_id, template, root, current_item_id, get_language())
+			html = get_cached_fragment(version, key)
+			if html is None:
+				html = render_template(context, template, data)
+				set_cached_fragment(version, key, html)
+			return html
 	
 	# render
 	return render_template(context, template, data)
 
-def get_navigation_menu(menu, root=None):
+def get_navigation_menu(menu, root=None, state=None):
 	this = None # currently display element; Menu or MenuItem
 	the_menu = None # complete menu; Menu
 	the_items = [] # current items; list of MenuItem
@@ -86,8 +106,11 @@ def get_navigation_menu(menu, root=None):
 	elif isinstance(menu, MenuItem):
 		the_menu = menu.menu
 		this = menu
+	elif state:
+		the_menu = state.get_menu(menu)
+		this = the_menu
 	else:
-		the_menu = Menu.objects.get(name=menu)
+		the_menu = get_cached_menu(menu)
 		this = the_menu
 	
 	# if root specified, get it now
@@ -117,7 +140,7 @@ def get_navigation_menu(menu, root=None):
 		}
 
 
-def get_current_items(menu, current_url):
+def get_current_items(menu, current_url, match_prefix=False, state=None):
 	''' Get info about where we are in the menu. '''
 	result = {
 		'current_item': None,
@@ -125,26 +148,26 @@ def get_current_items(menu, current_url):
 		'current_ancestor_items': [],
 		}
 	
+	if state is None:
+		state = NavigationState()
+	
 	the_menu = None
 	if isinstance(menu, Menu):
 		the_menu = menu
 	else:
-		the_menu = Menu.objects.get(name=menu)
+		the_menu = state.get_menu(menu)
 		
-	current_items = the_menu.find_items(url=current_url)
-	if len(current_items):
-		result['current_item'] = current_items[0]
-		result['current_parent_item'] = current_items[0].parent
-	
-		ancestor = result['current_parent_item']
-		while ancestor:
-			result['current_ancestor_items'].append(ancestor)
-			ancestor = ancestor.get_parent()
+	trail = state.get_trail(the_menu, current_url, match_prefix)
+	if trail:
+		result['current_item'] = trail[0]
+		result['current_ancestor_items'] = list(trail[1:])
+		if len(trail) > 1:
+			result['current_parent_item'] = trail[1]
 	return result
 
 
 @register.simple_tag(takes_context=True)
-def show_navigation_breadcrumbs(context, menu=None, sitemap=None, request_path=None, template='navigation/breadcrumbs.html'):
+def show_navigation_breadcrumbs(context, menu=None, sitemap=None, request_path=None, template='navigation/breadcrumbs.html', match_prefix=False):
 	""" Displays breadcrumbs for current page.
 	
 	It may use pages to figure out the page hierarchy. If you are using
@@ -161,6 +184,7 @@ def show_navigation_breadcrumbs(context, menu=None, sitemap=None, request_path=N
 	Arguments:
 	menu -- menu to use to figure out the hierarchy of pages
 	sitemap -- slug of sitemap to use
+	match_prefix -- if True, use the item with the longest URL that is a prefix of current URL
 	"""
 	
 	the_path = None
@@ -172,38 +196,43 @@ def show_navigation_breadcrumbs(context, menu=None, sitemap=None, request_path=N
 	if the_path == None:
 		return ''
 	
+	state = get_navigation_state(context)
+	version = state.version
+	
 	try:
-		items = get_navigation_breadcrumbs(the_path, menu, sitemap)
+		the_menu = get_breadcrumbs_menu(menu, sitemap, state)
 	except ObjectDoesNotExist:
 		name = menu or sitemap or '--'
 		return show_missing_menu(context, name, 'navigation/breadcrumbs-missing.html')
 	
+	# use cached breadcrumbs if possible
+	key = None
+	if get_fragment_cache() is not None:
+		trail = state.get_trail(the_menu, the_path, match_prefix)
+		current_item_id = trail[0].id if trail else None
+		key = get_fragment_key(version, 'breadcrumbs', the_menu.id, template, current_item_id, get_language())
+		html = get_cached_fragment(version, key)
+		if html is not None:
+			return html
+	
+	items = get_navigation_breadcrumbs(the_path, the_menu, match_prefix=match_prefix, state=state)
+	
 	data = {'items': items }
-	return render_template(context, template, data)
+	html = render_template(context, template, data)
+	
+	if key:
+		set_cached_fragment(version, key, html)
+	return html
 		
 
-def get_navigation_breadcrumbs(current_path, menu=None, sitemap=None):
+def get_navigation_breadcrumbs(current_path, menu=None, sitemap=None, match_prefix=False, state=None):
 	
-	
-	# get or create menu for sitemap as needed
-	if menu == None and sitemap:
-		sitemap = Sitemap.current_objects.get(slug=sitemap)
-		try:
-			menu = Menu.current_objects.filter(sitemap=sitemap).get()
-		except ObjectDoesNotExist:
-			# create menu
-			menu = Menu()
-			menu.name = unicode(sitemap)
-			menu.site = sitemap.site
-			menu.sitemap = sitemap
-			menu.save()
-			
-			from navigation.utils import refresh_menu_from_sitemap
-			refresh_menu_from_sitemap(menu, sitemap)
-		
+	if state is None:
+		state = NavigationState()
+	menu = get_breadcrumbs_menu(menu, sitemap, state)
 	
 	# create breadcrumbs from menu
-	items = get_breadcrumbs_from_menu(current_path, menu)
+	items = get_breadcrumbs_from_menu(current_path, menu, match_prefix, state)
 	
 	if not items:
 		return None
@@ -223,29 +252,96 @@ def get_navigation_breadcrumbs(current_path, menu=None, sitemap=None):
 	return items
 
 
-def get_breadcrumbs_from_menu(current_path, menu):
-	the_menu = None
+def get_breadcrumbs_menu(menu=None, sitemap=None, state=None):
+	''' Returns menu used to create breadcrumbs. 
+	
+	If sitemap is given, its menu is created as needed.
+	'''
+	
+	# get or create menu for sitemap as needed
+	if menu == None and sitemap:
+		try:
+			if state:
+				return state.get_sitemap_menu(sitemap)
+			return get_cached_sitemap_menu(sitemap)
+		except ObjectDoesNotExist:
+			sitemap = Sitemap.current_objects.get(slug=sitemap)
+			
+			# create menu
+			menu = Menu()
+			menu.name = unicode(sitemap)
+			menu.site = sitemap.site
+			menu.sitemap = sitemap
+			menu.save()
+			
+			from navigation.utils import refresh_menu_from_sitemap
+			refresh_menu_from_sitemap(menu, sitemap)
+	
 	if isinstance(menu, Menu):
-		the_menu = menu
+		return menu
 	elif isinstance(menu, MenuItem):
-		the_menu = menu.menu
+		return menu.menu
+	elif state:
+		return state.get_menu(menu)
 	else:
-		the_menu = Menu.objects.get(name=menu)
-		
-	current_items = the_menu.find_items(url=current_path)
+		return get_cached_menu(menu)
+
+
+def get_breadcrumbs_from_menu(current_path, menu, match_prefix=False, state=None):
+	if state is None:
+		state = NavigationState()
+	
+	the_menu = get_breadcrumbs_menu(menu, state=state)
+	trail = state.get_trail(the_menu, current_path, match_prefix)
 
-	if len(current_items):
-		breadcrumbs = []
-		item = current_items[0]
-		while item:
-			breadcrumbs.append(item)
-			item = item.parent
-		return breadcrumbs
+	if trail:
+		return list(trail)
 	else:
 		return None
 
 
 
+@register.simple_tag(takes_context=True)
+def navigation_prefetch(context, *names, **kwargs):
+	""" Loads menus used on the page at once, instead of one by one.
+	
+	Place it before other navigation tags:
+	{% navigation_prefetch "Main Menu" "Footer" sitemap="flatpages" %}
+	
+	Arguments:
+	names -- names of menus
+	sitemap -- slug of sitemap used by breadcrumbs
+	"""
+	sitemap = kwargs.get('sitemap')
+	state = get_navigation_state(context)
+	state.add_menus(prefetch_menus(names, [sitemap] if sitemap else [], state.version))
+	return ''
+
+
+def get_navigation_state(context):
+	""" Returns NavigationState shared by navigation tags of the page.
+	
+	It's kept in the request, or in the top-level context if there is no request.
+	Submenus get it from their parent menus and use its version as it is; for
+	other tags, it's updated to current menu version.
+	"""
+	if isinstance(context, Context):
+		return context['navigation_state']
+	
+	try:
+		state = context['navigation_state']
+	except KeyError:
+		request = context.get('request')
+		if request is not None:
+			state = get_request_state(request)
+		else:
+			state = NavigationState()
+			context.dicts[0]['navigation_state'] = state
+	
+	state.set_version(get_menu_version())
+	return state
+
+
 def show_missing_menu(context, menu, template):
 	if menu:
 		data = {'name': menu }
@@ -34,3 +34,5 @@ class MySitemapInfo(AbstractSitemapInfo):
         else:
             return True
 
+
+from navigation.tests.sitemaps import *
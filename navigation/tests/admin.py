@@ -38,7 +38,117 @@ class MenuAdminTest(TestCase):
         self.assertContains(response, '/fishes/goldfish/')
         self.assertNotContains(response, '/fishes/betta/')
 
-            
+    
+    def test_find_sitemap_items_by_term_substring(self):
+        client = self._get_admin_client()
+        response = client.get('/admin/navigation/menu/find-sitemap-items/', {'term': 'fish'})
+        self.assertContains(response, '/fishes/goldfish/')
+        self.assertContains(response, '/fishes/betta/')
+        
+        response = client.get('/admin/navigation/menu/find-sitemap-items/', {'term': 'oldfi'})
+        self.assertContains(response, '/fishes/goldfish/')
+        self.assertNotContains(response, '/fishes/betta/')
+    
+    def test_find_by_term_inside_word(self):
+        from navigation.search import SitemapSearchIndex
+        
+        index = SitemapSearchIndex([
+            {'title': 'Cat food', 'location': '/cat-food/'},
+            {'title': 'Seafood', 'location': '/seafood/'},
+            {'title': 'Dog toys', 'location': '/dog-toys/'},
+        ])
+        self.assertEqual(['Cat food', 'Seafood'], [item['title'] for item in index.find_by_term('food')])
+        self.assertEqual(['Cat food'], [item['title'] for item in index.find_by_term('t fo')])
+    
+    def test_find_sitemap_items_paginated(self):
+        import json
+        client = self._get_admin_client()
+        response = client.get('/admin/navigation/menu/find-sitemap-items/', {'url': '/fishes/'})
+        all_items = json.loads(response.content)
+        self.assertTrue(len(all_items) > 2)
+        
+        response = client.get('/admin/navigation/menu/find-sitemap-items/', {'url': '/fishes/', 'offset': 1, 'limit': 1})
+        self.assertEqual(all_items[1:2], json.loads(response.content))
+    
+    def test_views_invalidate_menus_after_commit(self):
+        from django.db import connection
+        from mock import patch
+        from navigation import cache
+        
+        client = self._get_admin_client()
+        depth = len(connection.savepoint_ids)
+        
+        for url, data in (('/admin/navigation/menu/1/refresh/', None), ('/admin/navigation/menu/1/delete/', {'post': 'yes'})):
+            depths = []
+            with patch.object(cache.cache, 'incr', side_effect=lambda key: depths.append(len(connection.savepoint_ids))):
+                if data:
+                    client.post(url, data)
+                else:
+                    client.get(url)
+            self.assertTrue(depths)
+            self.assertEqual(depth, depths[-1])
+        self.assertFalse(Menu.objects.filter(pk=1).exists())
+    
+    def test_children_view(self):
+        import json
+        from navigation.utils import refresh_menu_from_sitemap
+        
+        menu = Menu.objects.get(pk=1)
+        refresh_menu_from_sitemap(menu, menu.sitemap)
+        
+        client = self._get_admin_client()
+        response = client.get('/admin/navigation/menu/1/children/')
+        data = json.loads(response.content)
+        fishes = [i for i in data['items'] if i['url'] == '/fishes/'][0]
+        self.assertEqual(3, len(data['items']))
+        self.assertEqual(2, fishes['children_count'])
+        
+        response = client.get('/admin/navigation/menu/1/children/', {'parent': fishes['id']})
+        data = json.loads(response.content)
+        self.assertEqual(['/fishes/betta/', '/fishes/goldfish/'], sorted(i['url'] for i in data['items']))
+        
+        # not modified
+        etag = response['ETag']
+        response = client.get('/admin/navigation/menu/1/children/', {'parent': fishes['id']}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+    
+    def test_patch_view(self):
+        import json
+        from navigation.models import MenuItem
+        
+        client = self._get_admin_client()
+        operations = [{'op': 'insert', 'id': 'new-1', 'title': 'Sharks', 'url': '/sharks/'}]
+        response = client.post('/admin/navigation/menu/1/patch/', json.dumps(operations), content_type='application/json')
+        
+        new_id = json.loads(response.content)['ids']['new-1']
+        self.assertEqual('Sharks', MenuItem.objects.get(pk=new_id, menu=1).title)
+    
+    def test_patch_view_checks_permission_and_input(self):
+        import json
+        from django.contrib.auth.models import Permission, User
+        from navigation.models import MenuItem
+        
+        user = User.objects.create_user(username='staff', email='staff@example.com', password='staff')
+        user.is_staff = True
+        user.save()
+        client = Client()
+        client.login(username='staff', password='staff')
+        
+        operations = [{'op': 'insert', 'id': 'new-1', 'title': 'Sharks', 'url': '/sharks/'}]
+        response = client.post('/admin/navigation/menu/1/patch/', json.dumps(operations), content_type='application/json')
+        self.assertEqual(403, response.status_code)
+        self.assertEqual(0, MenuItem.objects.filter(title='Sharks').count())
+        
+        user.user_permissions.add(Permission.objects.get(codename='change_menu'))
+        response = client.post('/admin/navigation/menu/1/patch/', json.dumps(operations), content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        
+        response = client.post('/admin/navigation/menu/999/patch/', json.dumps(operations), content_type='application/json')
+        self.assertEqual(404, response.status_code)
+        
+        response = client.post('/admin/navigation/menu/1/patch/', json.dumps(['insert']), content_type='application/json')
+        self.assertEqual(400, response.status_code)
+    
     def _get_admin_client(self):
         from django.contrib.auth.models import User
         
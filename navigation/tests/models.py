@@ -68,6 +68,53 @@ class ModelTest(TestCase):
         item.status = 'disabled'
         self.assertFalse( item.is_enabled() )
 
+    def test_find_items(self):
+        menu = Menu.objects.get(name="Top")
+        
+        self.assertEqual([13], [i.id for i in menu.find_items(url='/bird/duck.html')])
+        self.assertEqual([], menu.find_items(url='/missing/'))
+        self.assertEqual([12], [i.id for i in menu.find_items(id=12)])
+        self.assertEqual([], menu.find_items(id=99))
+        self.assertEqual([13], [i.id for i in menu.get_item(id=12).children])
+        self.assertEqual(12, menu.get_item(id=13).parent.id)
+        self.assertEqual(set([11, 12]), set(i.id for i in menu.list_top_items()))
+
+    def test_clean_item_order(self):
+        MenuItem.objects.filter(pk=11).update(order=5)
+        MenuItem.objects.filter(pk=12).update(order=1)
+        MenuItem.objects.filter(pk=13).update(order=0)
+        
+        menu = Menu.objects.get(name="Top")
+        menu.clean_item_order()
+        
+        orders = dict(MenuItem.objects.values_list('id', 'order'))
+        self.assertEqual({12: 0, 13: 1, 11: 2}, orders)
+        
+        # nothing to save second time
+        self.assertNumQueries(1, menu.clean_item_order)
+    
+    def test_clean_item_order_batched(self):
+        menu = Menu.objects.get(name="Top")
+        MenuItem.objects.bulk_create([MenuItem(menu=menu, title='Page', url='/page-%d/' % i, order=100 - i) for i in range(50)])
+        
+        # one query reads items, one writes all of them
+        self.assertNumQueries(2, menu.clean_item_order)
+        self.assertEqual(range(53), list(menu.menuitem_set.order_by('order').values_list('order', flat=True)))
+    
+    def test_query_tree(self):
+        menu = Menu.objects.get(name="Top")
+        menu.clean_item_order()
+        
+        birds = MenuItem.objects.get(pk=12)
+        duck = MenuItem.objects.get(pk=13)
+        fish = MenuItem.objects.get(pk=11)
+        
+        self.assertEqual([13], [i.id for i in birds.query_descendants()])
+        self.assertEqual([], list(fish.query_descendants()))
+        self.assertEqual([12], [i.id for i in duck.query_ancestors()])
+        self.assertEqual([], list(birds.query_ancestors()))
+        self.assertEqual(1, duck.depth)
+
 class SitemapTest(TestCase):
     fixtures = ['flatpages']
     
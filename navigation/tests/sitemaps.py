@@ -1,3 +1,4 @@
+from django.test import TestCase
 from navigation.sitemaps import AbstractSitemapInfo
 from navigation.tests import MySitemapInfo
 
@@ -13,9 +14,48 @@ class SitemapInfoTest(TestCase):
         self.assertEqual(True, sitemap_info.item_enabled(item) )
         self.assertTrue(sitemap_info.item_uuid(item))
     
+    def test_items_data(self):
+        sitemap_info = MySitemapInfo()
+        sitemap_info.add_item({'location': '/', 'title':'Welcome'})
+        sitemap_info.add_item({'location': '/offices', 'title':'Our Offices', 'enabled': False})
+        
+        data = list(sitemap_info.items_data())
+        self.assertEqual(2, len(data))
+        self.assertEqual('/offices', data[1]['location'])
+        self.assertEqual('Our Offices', data[1]['title'])
+        self.assertEqual(False, data[1]['enabled'])
+        self.assertTrue(data[1]['uuid'])
+        self.assertNotEqual(data[0]['uuid'], data[1]['uuid'])
+    
+    def test_item_uuid(self):
+        from django.contrib.sites.models import Site
+        
+        sitemap_info = MySitemapInfo()
+        self.assertEqual('sites.site:3', sitemap_info.item_uuid(Site(pk=3)))
+        self.assertEqual(36, len(sitemap_info.item_uuid({'location': '/offices'})))
+    
     def test_name(self):
         sitemap_info = MySitemapInfo()
         self.assertEqual('test', unicode(sitemap_info))
         
     
-    
\ No newline at end of file
+    
+
+class FlatPageSitemapInfoTest(TestCase):
+    fixtures = ['flatpages']
+    
+    def test_items_data(self):
+        from django.contrib.flatpages.models import FlatPage
+        from navigation.sitemaps import FlatPageSitemapInfo
+        
+        sitemap_info = FlatPageSitemapInfo(1)
+        sitemap_info.chunk_size = 2
+        
+        data = list(sitemap_info.items_data())
+        self.assertEqual(FlatPage.objects.count(), len(data))
+        self.assertEqual(len(data), len(set(d['uuid'] for d in data)))
+        
+        page = FlatPage.objects.get(url='/fishes/goldfish/')
+        goldfish = [d for d in data if d['location'] == '/fishes/goldfish/'][0]
+        self.assertEqual('Goldfish', goldfish['title'])
+        self.assertEqual(sitemap_info.item_uuid(page), goldfish['uuid'])
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.db import connection
 from django.http import HttpRequest
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.template import TemplateDoesNotExist
 from django.template import Context as TemplateContext
 from django.template import RequestContext
@@ -72,6 +73,25 @@ class MenuTagTest(TestCase):
         self.assertEqual('Birds', info['current_item'].title)
         self.assertEqual(None, info['current_parent_item'])
         
+    def test_get_current_items_without_slash(self):
+        info = get_current_items('Top', '/bird')
+        self.assertEqual('Birds', info['current_item'].title)
+        
+        info = get_current_items('Top', '/bird/duck.html/')
+        self.assertEqual('Duck', info['current_item'].title)
+        self.assertEqual(['Birds'], [i.title for i in info['current_ancestor_items']])
+        
+    def test_get_current_items_match_prefix(self):
+        info = get_current_items('Top', '/bird/duck.html/photos/')
+        self.assertEqual(None, info['current_item'])
+        
+        info = get_current_items('Top', '/bird/duck.html/photos/', match_prefix=True)
+        self.assertEqual('Duck', info['current_item'].title)
+        self.assertEqual('Birds', info['current_parent_item'].title)
+        
+        info = get_current_items('Top', '/birds/', match_prefix=True)
+        self.assertEqual(None, info['current_item'])
+        
     def test_get_current_items_ancestors(self):
         info = get_current_items('Top', '/bird/duck.html')
         
@@ -80,6 +100,192 @@ class MenuTagTest(TestCase):
         self.assertEqual('Birds', info['current_parent_item'].title)
         self.assertEqual(1, len(info['current_ancestor_items']))
     
+    def test_get_menu_is_cached(self):
+        get_navigation_menu('Top')
+        
+        def get_menu():
+            info = get_navigation_menu('Top')
+            self.assertEquals(2, len(info['items']))
+        self.assertNumQueries(0, get_menu)
+        
+    def test_get_menu_cache_invalidated_on_save(self):
+        get_navigation_menu('Top')
+        
+        item = MenuItem.objects.get(pk=11)
+        item.status = 'disabled'
+        item.save()
+        
+        info = get_navigation_menu('Top')
+        self.assertEquals(1, len(info['items']))
+    
+    def test_get_menu_stale_while_loading(self):
+        from navigation.cache import _get_fill_lock, get_cached_menu, invalidate_menus
+        
+        stale_menu = get_cached_menu('Top')
+        invalidate_menus()
+        
+        # another thread is loading the menu
+        lock = _get_fill_lock((settings.SITE_ID, 'Top'))
+        lock.acquire()
+        try:
+            with self.assertNumQueries(0):
+                self.assertTrue(get_cached_menu('Top') is stale_menu)
+        finally:
+            lock.release()
+        self.assertFalse(get_cached_menu('Top') is stale_menu)
+    
+    def test_get_menu_stale_while_other_process_loads(self):
+        from django.core.cache import cache
+        from navigation.cache import get_cached_menu, get_menu_data_key, get_menu_version, invalidate_menus
+        
+        stale_menu = get_cached_menu('Top')
+        invalidate_menus()
+        
+        lock_key = get_menu_data_key(settings.SITE_ID, 'Top', get_menu_version()) + ':lock'
+        cache.add(lock_key, 1)
+        try:
+            with self.assertNumQueries(0):
+                self.assertTrue(get_cached_menu('Top') is stale_menu)
+        finally:
+            cache.delete(lock_key)
+        self.assertFalse(get_cached_menu('Top') is stale_menu)
+    
+    def test_get_menu_shared_between_processes(self):
+        from navigation.cache import clear_cached_menus, get_cached_menu
+        
+        get_cached_menu('Top')
+        clear_cached_menus()
+        
+        with self.assertNumQueries(0):
+            menu = get_cached_menu('Top')
+        self.assertEquals(2, len(menu.list_top_items()))
+    
+    @override_settings(NAVIGATION_FRAGMENT_CACHE=True)
+    def test_show_menu_item_fragment_cache(self):
+        context = TemplateContext({})
+        menu = Menu.objects.get(name='Top')
+        
+        html_11 = show_navigation_menu(context, menu.get_item(id=11))
+        html_12 = show_navigation_menu(context, menu.get_item(id=12))
+        self.assertNotEqual(html_11, html_12)
+        
+        with override_settings(NAVIGATION_FRAGMENT_CACHE=False):
+            self.assertEqual(html_12, show_navigation_menu(context, menu.get_item(id=12)))
+    
+    def test_show_menu_reads_version_once(self):
+        from mock import patch
+        from navigation import cache
+        
+        show_navigation_menu(TemplateContext({}), 'Top')
+        get = cache.cache.get
+        with patch.object(cache.cache, 'get', side_effect=get) as cache_get:
+            html = show_navigation_menu(TemplateContext({}), 'Top')
+        self.assertTrue('navigation-submenu' in html)
+        self.assertEqual(1, [args[0] for args, kwargs in cache_get.call_args_list].count(cache.VERSION_KEY))
+    
+    def test_submenu_reuses_navigation_state(self):
+        from mock import patch
+        from navigation.state import NavigationState
+        
+        state = NavigationState()
+        state.set_version('parent-version')
+        context = Context({'navigation_state': state, 'depth': 0, 'current_item': None,
+            'current_parent_item': None, 'current_ancestor_items': []})
+        
+        with patch('navigation.templatetags.navigation_tags.get_menu_version') as get_version:
+            get_version.return_value = 'new-version'
+            self.assertTrue(get_navigation_state(context) is state)
+            self.assertEqual('parent-version', state.version)
+            self.assertFalse(get_version.called)
+    
+    def test_prefetch(self):
+        from django.contrib.sites.models import Site
+        from django.template import Template
+        from navigation.cache import invalidate_menus
+        
+        Site.objects.get_current()
+        invalidate_menus()
+        template = Template('{% load navigation_tags %}{% navigation_prefetch "Top" "Bottom" "Missing" %}')
+        self.assertNumQueries(2, template.render, TemplateContext({}))
+        
+        with self.assertNumQueries(0):
+            self.assertEquals(2, len(get_navigation_menu('Top')['items']))
+            get_navigation_menu('Bottom')
+    
+    def test_prefetch_shared_between_processes(self):
+        from navigation.cache import clear_cached_menus, get_cached_menu, invalidate_menus, prefetch_menus
+        
+        invalidate_menus()
+        prefetch_menus(['Top', 'Bottom', 'Missing'])
+        clear_cached_menus()
+        
+        with self.assertNumQueries(0):
+            menus = prefetch_menus(['Top', 'Bottom', 'Missing'])
+            self.assertEquals(['Bottom', 'Top'], sorted(menus))
+            self.assertEquals(2, len(menus['Top'].list_top_items()))
+            self.assertRaises(Menu.DoesNotExist, get_cached_menu, 'Missing')
+    
+    def test_prefetch_while_other_process_loads(self):
+        from django.core.cache import cache
+        from navigation.cache import get_cached_menu, get_menu_data_key, get_menu_version, invalidate_menus, prefetch_menus
+        
+        stale_menu = get_cached_menu('Top')
+        invalidate_menus()
+        
+        lock_key = get_menu_data_key(settings.SITE_ID, 'Top', get_menu_version()) + ':lock'
+        cache.add(lock_key, 1)
+        try:
+            # only Bottom is loaded
+            with self.assertNumQueries(2):
+                menus = prefetch_menus(['Top', 'Bottom'])
+            self.assertTrue(menus['Top'] is stale_menu)
+            self.assertEquals('Bottom', menus['Bottom'].name)
+        finally:
+            cache.delete(lock_key)
+    
+    def test_menu_version_not_reused_when_evicted(self):
+        from django.core.cache import cache
+        from navigation.cache import VERSION_KEY, get_menu_version
+        
+        cache.delete(VERSION_KEY)
+        get_navigation_menu('Top')
+        version = get_menu_version()
+        cache.delete(VERSION_KEY)
+        MenuItem.objects.filter(pk=11).update(status='disabled')
+        
+        self.assertNotEqual(version, get_menu_version())
+        self.assertEquals(1, len(get_navigation_menu('Top')['items']))
+    
+    def test_get_menu_with_dummy_cache(self):
+        from django.core.cache import get_cache
+        from mock import patch
+        from navigation.cache import get_menu_version
+        
+        with patch('navigation.cache.cache', get_cache('django.core.cache.backends.dummy.DummyCache')):
+            self.assertNotEqual(get_menu_version(), get_menu_version())
+            self.assertEquals(2, len(get_navigation_menu('Top')['items']))
+            
+            item = MenuItem.objects.get(pk=11)
+            item.status = 'disabled'
+            item.save()
+            self.assertEquals(1, len(get_navigation_menu('Top')['items']))
+    
+    @override_settings(NAVIGATION_FRAGMENT_CACHE=True)
+    def test_show_menu_fragment_cache(self):
+        context = TemplateContext({})
+        html = show_navigation_menu(context, 'Top', request_path='/bird/')
+        self.assertTrue('Birds' in html)
+        
+        # changes without signals are not visible
+        MenuItem.objects.filter(pk=12).update(title='Crows')
+        self.assertEqual(html, show_navigation_menu(context, 'Top', request_path='/bird/'))
+        
+        # saving an item changes menu version
+        item = MenuItem.objects.get(pk=12)
+        item.save()
+        html = show_navigation_menu(context, 'Top', request_path='/bird/')
+        self.assertTrue('Crows' in html)
+    
 class BreadcrumbsTagTest(TestCase):
     fixtures = ['simple_menus', 'simple_site']
     
@@ -116,6 +322,10 @@ class BreadcrumbsTagTest(TestCase):
         self.assertEqual('Home', crumbs[0].title)
         self.assertEqual(3, len(crumbs))
         
+    def test_get_breadcrumbs_match_prefix(self):
+        crumbs = get_navigation_breadcrumbs('/bird/2014/', menu='Top', match_prefix=True)
+        self.assertEqual(['Home', 'Birds'], [c.title for c in crumbs])
+        
     def test_get_breadcrumbs_from_sitemap(self):
         manager = SitemapManager(1)
         
@@ -125,5 +335,36 @@ class BreadcrumbsTagTest(TestCase):
         self.assertTrue(crumbs)
         self.assertEqual('Home', crumbs[0].title)
         self.assertEqual(2, len(crumbs))
-   
-           
+    
+    def test_state_shared_by_tags(self):
+        from mock import patch
+        
+        request = HttpRequest()
+        request.path = '/bird/duck.html'
+        context = TemplateContext({'request': request})
+        
+        get_trail = Menu.get_trail
+        calls = []
+        def count_calls(menu, *args):
+            calls.append(args)
+            return get_trail(menu, *args)
+        
+        with patch.object(Menu, 'get_trail', count_calls):
+            menu = show_navigation_menu(context, 'Top')
+            crumbs = show_navigation_breadcrumbs(context, menu='Top')
+        
+        self.assertTrue('Duck' in menu)
+        self.assertTrue('Duck' in crumbs)
+        self.assertEqual(1, len(calls))
+        self.assertTrue(request.navigation_state.get_menu('Top') is get_cached_menu('Top'))
+    
+    def test_get_breadcrumbs_from_sitemap_prefetched(self):
+        from navigation.cache import invalidate_menus
+        
+        get_navigation_breadcrumbs('/about_us', sitemap='flatpages')
+        invalidate_menus()
+        
+        self.assertNumQueries(2, navigation_prefetch, TemplateContext({}), 'Top', sitemap='flatpages')
+        with self.assertNumQueries(0):
+            crumbs = get_navigation_breadcrumbs('/about_us', sitemap='flatpages')
+        self.assertEqual(2, len(crumbs))
@@ -1,5 +1,15 @@
-from django.test import TestCase
+from django.conf import settings
+from django.dispatch import Signal
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from navigation.sitemaps import AbstractSitemapInfo
+
+
+pages_changed = Signal()
+
+class SignalSitemapInfo(AbstractSitemapInfo):
+    slug = 'signal-pages'
+    change_signals = ('navigation.tests.utils.pages_changed', )
     
 
     
@@ -89,6 +99,29 @@ class RefreshTest(TestCase):
         self.assertEquals(None, menu_item.parent)
         
     
+    def test_refresh_menu_from_sitemap__new_parent(self):
+        from navigation.models import Menu, MenuItem, Sitemap
+        from navigation.utils import get_menu_diff, refresh_menu_from_sitemap
+        from mock import MagicMock
+
+        sitemap = Sitemap.objects.get(slug='flatpages')
+        menu = Menu.objects.get(sitemap=sitemap)
+        
+        items = [{'uuid' : 'child', 'title': 'Child', 'location':'/child/', 'parent': None}]
+        sitemap.get_items = MagicMock(return_value=items)
+        refresh_menu_from_sitemap(menu, sitemap)
+        
+        # existing item is moved under a new item
+        items.insert(0, {'uuid' : 'home', 'title': 'Home', 'location':'/', 'parent': None})
+        items[1]['parent'] = '/'
+        
+        diff = get_menu_diff(menu, sitemap)
+        self.assertEquals((1, 1, 0), (len(diff.new_items), len(diff.changed_items), len(diff.deleted_items)))
+        self.assertEquals(1, MenuItem.objects.count())
+        
+        refresh_menu_from_sitemap(menu, sitemap)
+        self.assertEquals('/', MenuItem.objects.get(title='Child').parent.url)
+        
     def test_refresh_menu_from_sitemap__empty_menu(self):        
         from navigation.models import Menu, MenuItem, Sitemap
         from navigation.utils import refresh_menu_from_sitemap
@@ -185,4 +218,428 @@ class RefreshTest(TestCase):
         
         # check
         self.assertEquals(0, len(menu.list_all_items()))
-        
\ No newline at end of file
+            
+    def test_refresh_menu_from_sitemap__query_count(self):
+        ''' Refreshing unchanged menu should not write anything. '''
+        from navigation.models import Menu, Sitemap
+        from navigation.utils import get_menu_diff
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from mock import MagicMock
+        
+        sitemap = Sitemap.objects.get(slug='flatpages')
+        menu = Menu.objects.get(sitemap=sitemap)
+        
+        def count_queries(size):
+            items = [{'uuid' : 'home', 'title': 'Home', 'location':'/', 'parent': None}]
+            for i in range(size):
+                items.append({'uuid' : 'page-%d' % i, 'title': 'Page', 'location':'/page-%d/' % i, 'parent': '/'})
+            sitemap.get_items = MagicMock(return_value=items)
+            get_menu_diff(menu, sitemap).apply()
+            
+            with CaptureQueriesContext(connection) as queries:
+                get_menu_diff(menu, sitemap).apply()
+            return len(queries)
+        
+        self.assertEquals(count_queries(5), count_queries(50))
+        self.assertEquals(50, menu.menuitem_set.filter(my_parent__url='/').count())
+        self.assertEquals(50, menu.menuitem_set.get(url='/').query_descendants().count())
+    
+    def test_refresh_menu_from_sitemap__query_count_shifted(self):
+        ''' A new page at the top shifts all items, but they are written in batches. '''
+        from navigation.models import Menu, Sitemap
+        from navigation.utils import get_menu_diff
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from mock import MagicMock
+        
+        sitemap = Sitemap.objects.get(slug='flatpages')
+        menu = Menu.objects.get(sitemap=sitemap)
+        
+        def count_queries(size):
+            items = [{'uuid' : 'page-%d' % i, 'title': 'Page', 'location':'/page-%d/' % i, 'parent': None} for i in range(size)]
+            sitemap.get_items = MagicMock(return_value=items)
+            get_menu_diff(menu, sitemap).apply()
+            
+            sitemap.get_items = MagicMock(return_value=[{'uuid' : 'first', 'title': 'First', 'location':'/first/', 'parent': None}] + items)
+            with CaptureQueriesContext(connection) as queries:
+                get_menu_diff(menu, sitemap).apply()
+            return len(queries)
+        
+        self.assertEquals(count_queries(5), count_queries(50))
+        self.assertEquals(range(51), list(menu.menuitem_set.order_by('order').values_list('order', flat=True)))
+        self.assertEquals(['/first/', '/page-0/'], list(menu.menuitem_set.order_by('order').values_list('url', flat=True)[:2]))
+    
+    def test_refresh_menus__reads_sitemap_once(self):
+        from navigation.models import Menu, Sitemap
+        from navigation.utils import get_sitemap_info_with_slug, refresh_menus
+        from mock import patch
+        
+        sitemap = Sitemap.objects.get(slug='flatpages')
+        for name in ('Main', 'Footer', 'Side'):
+            Menu.objects.create(name=name, site_id=sitemap.site_id)
+        
+        info = get_sitemap_info_with_slug('flatpages')
+        with patch.object(info, 'items_data', wraps=info.items_data) as items_data:
+            refresh_menus(Menu.objects.all(), Sitemap.objects.filter(slug='flatpages'))
+        
+        self.assertEquals(1, items_data.call_count)
+        self.assertEquals(6, Menu.objects.get(sitemap=sitemap).menuitem_set.count())
+    
+    def test_upgrade_sitemap_item_ids(self):
+        from django.contrib.flatpages.models import FlatPage
+        from navigation.models import Menu, MenuItem, Sitemap
+        from navigation.utils import refresh_menu_from_sitemap, upgrade_sitemap_item_ids
+        
+        sitemap = Sitemap.objects.get(slug='flatpages')
+        menu = Menu.objects.get(sitemap=sitemap)
+        refresh_menu_from_sitemap(menu, sitemap)
+        
+        # pretend items were created by older version
+        info = sitemap._get_info()
+        page = FlatPage.objects.get(url='/birds/')
+        MenuItem.objects.filter(url='/birds/').update(sitemap_item_id=info.legacy_uuid(page))
+        
+        self.assertEquals(1, upgrade_sitemap_item_ids())
+        self.assertEquals('flatpages.flatpage:%s' % page.pk, MenuItem.objects.get(url='/birds/').sitemap_item_id)
+
+
+class ParallelRefreshTest(TransactionTestCase):
+    fixtures = ['flatpages']
+    
+    def setUp(self):
+        from navigation.utils import discover_sitemaps
+        discover_sitemaps()
+    
+    def test_refresh_menus_with_workers(self):
+        import threading
+        from navigation.models import Menu, MenuItem, Sitemap
+        from navigation.utils import refresh_menus
+        
+        sitemap = Sitemap.objects.get(slug='flatpages')
+        for name in ('Main', 'Footer', 'Side'):
+            Menu.objects.create(name=name, site_id=sitemap.site_id)
+        main = Menu.objects.get(name='Main')
+        MenuItem.objects.create(menu=main, title='Old', url='/old/', sitemap=sitemap, sitemap_item_id='missing')
+        
+        threads = set()
+        with self._share_connection_with_workers(threads):
+            diffs = refresh_menus(Menu.objects.all(), Sitemap.objects.filter(slug='flatpages'), workers=2)
+        
+        self.assertTrue(threading.current_thread() not in threads)
+        self.assertEqual(4, len(diffs))
+        counts = dict((diff.menu.name, (len(diff.new_items), len(diff.changed_items), len(diff.deleted_items))) for diff in diffs)
+        self.assertEqual((6, 0, 0), counts[Menu.objects.get(sitemap=sitemap).name])
+        self.assertEqual((0, 0, 1), counts['Main'])
+        self.assertEqual((0, 0, 0), counts['Footer'])
+        self.assertEqual(6, MenuItem.objects.count())
+    
+    def _share_connection_with_workers(self, threads):
+        ''' Lets worker threads use the test database.
+        
+        In-memory SQLite databases can't be opened by other threads, so workers
+        use the connection of the test, one at a time, like LiveServerTestCase.
+        Other databases are opened by the workers themselves.
+        '''
+        import threading
+        from contextlib import contextmanager
+        from django.db import connections, transaction
+        from mock import patch
+        from navigation import utils
+        
+        connection = connections['default']
+        in_own_connection = utils._in_own_connection
+        lock = threading.Lock()
+        
+        def share_connection(func):
+            def wrapper(*args, **kwargs):
+                threads.add(threading.current_thread())
+                with lock:
+                    connections['default'] = connection
+                    with transaction.atomic():
+                        return func(*args, **kwargs)
+            return wrapper
+        
+        def record_thread(func):
+            def wrapper(*args, **kwargs):
+                threads.add(threading.current_thread())
+                return func(*args, **kwargs)
+            return in_own_connection(wrapper)
+        
+        @contextmanager
+        def context():
+            if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] == ':memory:':
+                connection.allow_thread_sharing = True
+                try:
+                    with patch.object(utils, '_in_own_connection', share_connection):
+                        yield
+                finally:
+                    connection.allow_thread_sharing = False
+            else:
+                with patch.object(utils, '_in_own_connection', record_thread):
+                    yield
+        return context()
+
+
+class InferParentsTest(TestCase):
+    def test_infer_parents_by_url(self):
+        from navigation.utils import infer_parents_by_url
+        
+        urls = ['/', '/fishes', '/fishes/goldfish/', '/birds/', '/birds/duck.html', '/birds/geese/canada/']
+        self.assertEquals([None, 0, 1, 0, 3, 3], infer_parents_by_url(urls))
+    
+    def test_infer_parents_by_url__without_root(self):
+        from navigation.utils import infer_parents_by_url
+        
+        urls = ['/fishes/', '/fishes/goldfish/', '/fishes/goldfish/#food']
+        self.assertEquals([None, 0, 1], infer_parents_by_url(urls))
+
+
+class SitemapRegistryTest(TestCase):
+    def test_get_info(self):
+        from navigation.registry import registry
+        from navigation.sitemaps import FlatPageSitemapInfo
+        
+        info = registry.get_info('flatpages')
+        self.assertTrue(isinstance(info, FlatPageSitemapInfo))
+        self.assertTrue(info is registry.get_info('flatpages'))
+        self.assertEqual(None, registry.get_info('missing'))
+    
+    def test_duplicate_slug(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from django.test.utils import override_settings
+        from navigation.registry import registry
+        
+        sitemaps = ('navigation.sitemaps.FlatPageSitemapInfo', 'navigation.sitemaps.FlatPageSitemapInfo')
+        with override_settings(NAVIGATION_SITEMAPS=sitemaps):
+            self.assertRaises(ImproperlyConfigured, registry.get_classes)
+        self.assertEqual(len(settings.NAVIGATION_SITEMAPS), len(registry.get_classes()))
+
+
+class MenuOperationsTest(TestCase):
+    fixtures = ['simple_menus', 'simple_site']
+    
+    def test_apply_menu_operations(self):
+        from navigation.cache import get_menu_version
+        from navigation.models import Menu, MenuItem
+        from navigation.utils import apply_menu_operations
+        
+        menu = Menu.objects.get(name='Top')
+        version = get_menu_version()
+        
+        new_ids = apply_menu_operations(menu, [
+            {'op': 'insert', 'id': 'new-1', 'title': 'Goose', 'url': '/bird/goose.html', 'parent_id': 12, 'position': 0},
+            {'op': 'insert', 'id': 'new-2', 'title': 'Egg', 'url': '/bird/egg.html', 'parent_id': 'new-1'},
+            {'op': 'rename', 'id': 11, 'title': 'Fishes'},
+            {'op': 'set_status', 'id': 11, 'status': 'disabled'},
+            {'op': 'move', 'id': 13, 'parent_id': None, 'position': 0},
+            {'op': 'delete', 'id': 12},
+            ])
+        
+        self.assertEqual(version + 1, get_menu_version())
+        self.assertEqual(set(['new-1', 'new-2']), set(new_ids))
+        self.assertEqual(0, MenuItem.objects.filter(pk__in=new_ids.values()).count())
+        
+        items = list(Menu.objects.get(name='Top').list_all_items())
+        self.assertEqual([13, 11], [i.id for i in items])
+        self.assertEqual('Fishes', items[1].title)
+        self.assertEqual('disabled', items[1].status)
+        self.assertEqual(None, items[0].my_parent_id)
+    
+    def test_apply_menu_operations__invalidates_after_commit(self):
+        from django.db import connection
+        from mock import patch
+        from navigation import cache
+        from navigation.models import Menu
+        from navigation.utils import apply_menu_operations
+        
+        menu = Menu.objects.get(name='Top')
+        depth = len(connection.savepoint_ids)
+        depths = []
+        with patch.object(cache.cache, 'incr', side_effect=lambda key: depths.append(len(connection.savepoint_ids))):
+            apply_menu_operations(menu, [{'op': 'rename', 'id': 11, 'title': 'Fishes'}])
+        self.assertEqual([depth], depths)
+    
+    def test_apply_menu_operations__cycle(self):
+        from django.core.exceptions import SuspiciousOperation
+        from navigation.models import Menu, MenuItem
+        from navigation.utils import apply_menu_operations
+        
+        menu = Menu.objects.get(name='Top')
+        self.assertRaises(SuspiciousOperation, apply_menu_operations, menu, [
+            {'op': 'rename', 'id': 12, 'title': 'Changed'},
+            {'op': 'move', 'id': 12, 'parent_id': 13},
+            ])
+        self.assertEqual('Birds', MenuItem.objects.get(pk=12).title)
+
+
+class DiscoverSitemapsTest(TestCase):
+    def test_ensure_sitemaps_discovered(self):
+        from navigation.models import Sitemap
+        from navigation.registry import registry
+        from navigation.utils import ensure_sitemaps_discovered
+        
+        registry.discovered_sites.clear()
+        ensure_sitemaps_discovered()
+        self.assertEqual(1, Sitemap.objects.filter(slug='flatpages').count())
+        
+        self.assertNumQueries(0, ensure_sitemaps_discovered)
+    
+    def test_command(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from navigation.models import Sitemap
+        
+        out = StringIO()
+        call_command('discover_sitemaps', stdout=out)
+        self.assertEqual(1, Sitemap.objects.filter(slug='flatpages').count())
+        self.assertTrue('flatpages' in out.getvalue())
+
+
+class RefreshNavigationCommandTest(TestCase):
+    fixtures = ['flatpages']
+    
+    def setUp(self):
+        from navigation.utils import discover_sitemaps
+        discover_sitemaps()
+    
+    def test_dry_run(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from navigation.models import MenuItem
+        
+        out = StringIO()
+        call_command('refresh_navigation', dry_run=True, sitemaps=['flatpages'], stdout=out)
+        
+        self.assertEqual(0, MenuItem.objects.count())
+        self.assertTrue('6 new' in out.getvalue())
+        self.assertTrue('+ Birds (/birds/)' in out.getvalue())
+        self.assertTrue('fetch:' in out.getvalue())
+    
+    def test_refresh(self):
+        from StringIO import StringIO
+        from django.contrib.flatpages.models import FlatPage
+        from django.core.management import call_command
+        from navigation.models import MenuItem
+        
+        call_command('refresh_navigation', stdout=StringIO())
+        self.assertEqual(6, MenuItem.objects.count())
+        
+        FlatPage.objects.filter(url='/birds/').update(title='Bird')
+        out = StringIO()
+        call_command('refresh_navigation', dry_run=True, stdout=out)
+        self.assertTrue('0 new, 1 changed, 0 deleted' in out.getvalue())
+        self.assertEqual('Birds', MenuItem.objects.get(url='/birds/').title)
+        
+        call_command('refresh_navigation', stdout=StringIO())
+        self.assertEqual('Bird', MenuItem.objects.get(url='/birds/').title)
+
+
+class RefreshQueueTest(TestCase):
+    fixtures = ['flatpages']
+    
+    def setUp(self):
+        from navigation.utils import discover_sitemaps
+        discover_sitemaps()
+    
+    @override_settings(NAVIGATION_AUTO_REFRESH_THREAD=False, NAVIGATION_AUTO_REFRESH_DELAY=60)
+    def test_requests_are_merged(self):
+        from navigation.autorefresh import RefreshQueue
+        from navigation.models import MenuItem
+        
+        queue = RefreshQueue()
+        for i in range(3):
+            queue.add(settings.SITE_ID, 'flatpages')
+        
+        self.assertEqual([(settings.SITE_ID, 'flatpages')], queue.get_pending())
+        self.assertEqual(0, queue.run_pending())
+        self.assertEqual(0, MenuItem.objects.count())
+        
+        self.assertEqual(1, queue.run_pending(force=True))
+        self.assertEqual([], queue.get_pending())
+        self.assertEqual(6, MenuItem.objects.count())
+    
+    @override_settings(NAVIGATION_AUTO_REFRESH_THREAD=False, NAVIGATION_AUTO_REFRESH_DELAY=10,
+        NAVIGATION_AUTO_REFRESH_MAX_DELAY=25)
+    def test_requests_delay_refresh(self):
+        from mock import patch
+        from navigation.autorefresh import RefreshQueue
+        
+        queue = RefreshQueue()
+        with patch('time.time') as now:
+            for t, refreshed in ((0, None), (8, None), (12, 0), (16, None), (24, 0), (25, 1)):
+                now.return_value = 1000 + t
+                if refreshed is None:
+                    queue.add(settings.SITE_ID, 'flatpages')
+                else:
+                    self.assertEqual(refreshed, queue.run_pending())
+        self.assertEqual([], queue.get_pending())
+    
+    @override_settings(NAVIGATION_AUTO_REFRESH_THREAD=False, NAVIGATION_AUTO_REFRESH_DELAY=60)
+    def test_refresh_when_request_finished(self):
+        from django.core.signals import request_finished
+        from django.db import close_old_connections
+        from mock import patch
+        from navigation.autorefresh import RefreshQueue, connect_listeners
+        from navigation.models import MenuItem
+        
+        with patch('navigation.autorefresh._connected', []):
+            with patch('navigation.autorefresh.queue', RefreshQueue()) as queue:
+                connect_listeners()
+                queue.add(settings.SITE_ID, 'flatpages')
+                self.assertEqual(0, MenuItem.objects.count())
+                
+                # like the test client, keep the test's database connection open
+                request_finished.disconnect(close_old_connections)
+                try:
+                    request_finished.send(sender=None)
+                finally:
+                    request_finished.connect(close_old_connections)
+                self.assertEqual([], queue.get_pending())
+                self.assertEqual(6, MenuItem.objects.count())
+    
+    def test_thread_refreshes_outside_transaction(self):
+        from django.db import connection
+        from mock import patch
+        from navigation.autorefresh import RefreshQueue
+        
+        class Stop(BaseException):
+            pass
+        
+        depths = []
+        def run_pending():
+            depths.append(len(connection.savepoint_ids))
+            raise Stop()
+        
+        queue = RefreshQueue()
+        queue._pending[(settings.SITE_ID, 'flatpages')] = (0, 0)
+        depth = len(connection.savepoint_ids)
+        # the test's connection stays open
+        with patch('django.db.connections.all', return_value=[]):
+            with patch.object(queue, 'run_pending', side_effect=run_pending):
+                self.assertRaises(Stop, queue._run)
+        self.assertEqual([depth], depths)
+    
+    @override_settings(NAVIGATION_AUTO_REFRESH_THREAD=False, NAVIGATION_AUTO_REFRESH_DELAY=0)
+    def test_no_delay(self):
+        from navigation.autorefresh import RefreshQueue
+        from navigation.models import MenuItem
+        
+        RefreshQueue().add(settings.SITE_ID, 'flatpages')
+        self.assertEqual(6, MenuItem.objects.count())
+
+    def test_connect_listeners(self):
+        from mock import patch
+        from navigation.autorefresh import RefreshQueue, connect_listeners
+        from navigation.registry import registry
+        
+        sitemaps = ('navigation.tests.utils.SignalSitemapInfo', )
+        with override_settings(NAVIGATION_SITEMAPS=sitemaps, NAVIGATION_AUTO_REFRESH=True,
+                NAVIGATION_AUTO_REFRESH_THREAD=False, NAVIGATION_AUTO_REFRESH_DELAY=60):
+            with patch('navigation.autorefresh._connected', []):
+                with patch('navigation.autorefresh.queue', RefreshQueue()) as queue:
+                    connect_listeners()
+                    self.assertEqual({}, registry._instances)
+                    
+                    pages_changed.send(sender=None)
+                    self.assertEqual([(settings.SITE_ID, 'signal-pages')], queue.get_pending())
@@ -1,113 +1,308 @@
 
+import threading
+import time
+from contextlib import contextmanager
+
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
-from django.db import models
-from django.utils.importlib import import_module
+from django.core.exceptions import ObjectDoesNotExist, SuspiciousOperation
+from django.db import models, transaction
 from django.utils.translation import pgettext
 
 def discover_sitemaps():
+    ''' Creates Sitemap objects for sitemaps of current site that don't have them yet. '''
     from django.contrib.sites.models import Site
     from navigation.models import Sitemap
+    from .registry import registry
+    
+    site = Site.objects.get_current()
+    existing_slugs = set(Sitemap.current_objects.values_list('slug', flat=True))
     
-    for info in get_sitemap_info_list():
-        if Sitemap.current_objects.filter(slug=info.slug).count() == 0:
+    for cls in registry.get_classes():
+        if cls.slug not in existing_slugs:
             sitemap = Sitemap()
-            sitemap.site = Site.objects.get_current()
-            sitemap.slug = info.slug
+            sitemap.site = site
+            sitemap.slug = cls.slug
             sitemap.save()
     
-def initialize_autorefresh():	
-    def refresh(info):
-        from navigation.models import Sitemap, Menu
-        from django.contrib.sites.models import Site
-        
-        if not getattr(settings, 'NAVIGATION_AUTO_REFRESH', False):
-            return False
+    registry.discovered_sites.add(site.id)
 
+def ensure_sitemaps_discovered():
+    ''' Discovers sitemaps once per process, or again after NAVIGATION_SITEMAPS changes. '''
+    from django.contrib.sites.models import Site
+    from .registry import registry
+    
+    if Site.objects.get_current().id not in registry.discovered_sites:
         discover_sitemaps()
-        for sitemap in Sitemap.current_objects.filter(slug=info.slug):
-            for menu in Menu.current_objects.all():
-                refresh_menu_from_sitemap(menu, sitemap)
+    
+def initialize_autorefresh():	
+    ''' Refreshes menus when sitemaps change.
+    
+    Refreshes are queued and done later; see navigation.autorefresh.RefreshQueue.
+    With NAVIGATION_AUTO_REFRESH, it's done on the first request. Call it in scripts
+    that change pages without handling requests.
+    '''
+    from .autorefresh import connect_listeners
+    connect_listeners()
 
-    for info in get_sitemap_info_list():
-        info.add_listener(refresh)
+def get_sitemap_info_with_slug(slug, site_id=None):
+    from .registry import registry
+    return registry.get_info(slug, site_id)
+    
+def get_sitemap_info_list():
+    ''' Returns a list of SitemapInfo objects.
+    
+    NAVIGATION_SITEMAPS should be included in settings.py
+    This should be a list of classes that implements SitemapInfo. 
+    Those objects are loaded once and reused.
+    '''
+    from .registry import registry
+    return registry.get_info_list()
+    
+def upgrade_sitemap_item_ids():
+    ''' Replaces ids of menu items created by version 0.2 and older with current ids.
+    
+    Returns number of updated menu items.
+    '''
+    from .cache import invalidate_menus
+    
+    with transaction.atomic():
+        count = _upgrade_sitemap_item_ids()
+    invalidate_menus()
+    return count
 
-def _get_sitemap_classes():
-    try:
-        settings_list = settings.NAVIGATION_SITEMAPS
-    except AttributeError:
-        raise ImproperlyConfigured('Add NAVIGATION_SITEMAPS to your settings.py file.')
+def _upgrade_sitemap_item_ids():
+    ''' Does the work of upgrade_sitemap_item_ids() in the current transaction; migrations use it. '''
+    from .models import MenuItem, Sitemap
+    
+    changed_items = []
+    for sitemap in Sitemap.objects.all():
+        if not sitemap.is_available():
+            continue
+        
+        info = sitemap._get_info()
+        new_ids = {}
+        for item in info.items():
+            new_ids[info.legacy_uuid(item)] = info.item_uuid(item)
+        
+        for pk, old_id in sitemap.menuitem_set.values_list('id', 'sitemap_item_id'):
+            if old_id in new_ids:
+                changed_items.append(MenuItem(id=pk, sitemap_item_id=new_ids[old_id]))
+    
+    update_items(changed_items, ('sitemap_item_id', ))
+    return len(changed_items)
+    
+def refresh_all_menus(workers=None):
+    from .models import Menu
+    refresh_menus(Menu.current_objects.all(), workers=workers)
+    
+def refresh_menus(menus, sitemaps=None, workers=None, dry_run=False, timer=None):
+    ''' Refreshes given menus from all available sitemaps.
+    
+    Items of each sitemap are read once and shared by all menus. Menus are
+    refreshed by a pool of threads, one menu per thread at a time, each with
+    its own database connection. Number of threads is given by workers or by
+    NAVIGATION_REFRESH_WORKERS (default 1, which refreshes menus in the
+    calling thread).
+    
+    dry_run -- compute changes without saving them
+    timer -- StageTimer that measures fetch, diff, write and reorder stages
+    
+    Returns list of MenuDiff objects.
+    '''
+    from .cache import invalidate_menus
+    from .models import Sitemap
+    
+    if timer is None:
+        timer = StageTimer()
+    if sitemaps is None:
+        sitemaps = Sitemap.current_objects.all()
+    sitemaps = [sitemap for sitemap in sitemaps if sitemap.is_available()]
+    
+    items = {}
+    with timer.stage('fetch'):
+        for sitemap in sitemaps:
+            items[sitemap.id] = list(sitemap.get_items())
+    
+    tasks = []
+    for menu in menus:
+        menu_sitemaps = [sitemap for sitemap in sitemaps if menu.sitemap_id in (None, sitemap.id)]
+        if menu_sitemaps:
+            tasks.append((menu, menu_sitemaps))
+    
+    def refresh(task):
+        menu, menu_sitemaps = task
+        diffs = []
+        for sitemap in menu_sitemaps:
+            diffs.append(refresh_menu_from_sitemap(menu, sitemap, items[sitemap.id], dry_run, timer))
+        return diffs
     
+    if workers is None:
+        workers = getattr(settings, 'NAVIGATION_REFRESH_WORKERS', 1)
     
-    info_list = []
-    for full_name in settings_list:
-        module_name, class_name = full_name.rsplit('.', 1)
+    if workers > 1 and len(tasks) > 1:
+        from multiprocessing.pool import ThreadPool
         
+        pool = ThreadPool(min(workers, len(tasks)))
         try:
-            module = import_module(module_name)
-            cls = getattr(module, class_name)
-        except (ImportError, AttributeError):
-            raise ImproperlyConfigured('Failed to load sitemap info: %s' % full_name)
-            
-        yield cls
+            results = pool.map(_in_own_connection(refresh), tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+        for task in tasks:
+            with transaction.atomic():
+                results.append(refresh(task))
+    
+    if not dry_run:
+        invalidate_menus()
+    return [diff for diffs in results for diff in diffs]
+    
+def _in_own_connection(func):
+    ''' Runs func in a transaction and closes database connections of the thread afterwards.
+    
+    SQLite allows only one writer at a time, and concurrent transactions fail
+    with "database is locked"; with SQLite, threads write one at a time.
+    '''
+    from django.db import connection
+    
+    def wrapper(*args, **kwargs):
+        if connection.vendor == 'sqlite':
+            with _sqlite_lock:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+        with transaction.atomic():
+            return func(*args, **kwargs)
+    return _closing_connections(wrapper)
 
-def get_sitemap_info_with_slug(slug):
-    candidate_classes = []
+def _closing_connections(func):
+    ''' Runs func and closes database connections of the thread afterwards. '''
+    from django.db import connections
     
-    for cls in _get_sitemap_classes():
-        if cls.slug == slug:
-            candidate_classes.append(cls)
-            
-    if len(candidate_classes) == 0:
-        return None
-    if len(candidate_classes) == 1:
-        return candidate_classes[0]( settings.SITE_ID )
-    if len(candidate_classes) > 1:
-        raise Exception("Multiple sitemaps are registered with the same slug: " + slug)
-    assert(False)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for conn in connections.all():
+                conn.close()
+    return wrapper
+
+_sqlite_lock = threading.Lock()
     
-def get_sitemap_info_list():
-    ''' Returns a list of SitemapInfo objects.
+def refresh_menu_from_sitemap(menu, sitemap, sitemap_items=None, dry_run=False, timer=None):
+    ''' Refreshes menu items based on changes in sitemap.
     
-    NAVIGATION_SITEMAPS should be included in settings.py
-    This should be a list of classes that implements SitemapInfo. 
-    Those objects are loaded and returned.
+    sitemap_items -- result of sitemap.get_items(), if it is already known
+    dry_run -- compute changes without saving them
+    timer -- StageTimer that measures fetch, diff, write and reorder stages
+    
+    Returns MenuDiff with the changes.
     '''
-    info_list = []
-    for cls in _get_sitemap_classes():
-        info_list.append( cls( settings.SITE_ID ) )
-    return info_list
+    from .cache import batch_invalidation, invalidate_menus
+    
+    if timer is None:
+        timer = StageTimer()
+    if sitemap_items is None:
+        with timer.stage('fetch'):
+            sitemap_items = list(sitemap.get_items())
     
-def refresh_all_menus():
-    from .models import Menu, Sitemap
+    with timer.stage('diff'):
+        diff = get_menu_diff(menu, sitemap, sitemap_items)
+    if dry_run:
+        return diff
     
-    for sitemap in Sitemap.current_objects.all():
-        if sitemap.is_available():
-            for menu in Menu.current_objects.all():
-                if menu.sitemap == None or menu.sitemap == sitemap:
-                    refresh_menu_from_sitemap(menu, sitemap)
-    return
+    with batch_invalidation():
+        with timer.stage('write'):
+            diff.apply()
+        with timer.stage('reorder'):
+            menu.clean_item_order()
+        invalidate_menus()
+    return diff
     
-def refresh_menu_from_sitemap(menu, sitemap):
-    ''' Refreshes menu items based on changes in sitemap. '''
+def get_menu_diff(menu, sitemap, sitemap_items=None):
+    ''' Returns MenuDiff with changes that refresh menu from the sitemap. 
+    
+    A menu created for the sitemap is rebuilt entirely. In other menus, only
+    items that link to the sitemap are updated or deleted.
+    '''
+    if sitemap_items is None:
+        sitemap_items = sitemap.get_items()
     
     if menu.sitemap == sitemap:
-        _refresh_menu_from_sitemap_full(menu, sitemap)
+        return _diff_menu_with_sitemap_full(menu, sitemap, sitemap_items)
     else:
-        _refresh_menu_from_sitemap_items(menu, sitemap)
+        return _diff_menu_with_sitemap_items(menu, sitemap, sitemap_items)
+    
+
+class MenuDiff(object):
+    ''' Changes of menu items needed to refresh a menu from a sitemap.
+    
+    new_items -- unsaved MenuItem objects
+    changed_items -- MenuItem objects with modified fields
+    deleted_items -- MenuItem objects to delete
+    parents -- for each new item, index of its parent in new_items, existing parent or None
+    new_parents -- for changed items whose parent is new, index of the parent in new_items by item id
+    '''
+    
+    def __init__(self, menu, sitemap):
+        self.menu = menu
+        self.sitemap = sitemap
+        self.new_items = []
+        self.changed_items = []
+        self.deleted_items = []
+        self.parents = []
+        self.new_parents = {}
+    
+    def __len__(self):
+        return len(self.new_items) + len(self.changed_items) + len(self.deleted_items)
+    
+    def describe(self):
+        ''' Returns list of lines describing the changes. '''
+        lines = []
+        for prefix, items in (('+', self.new_items), ('~', self.changed_items), ('-', self.deleted_items)):
+            for menu_item in items:
+                lines.append(u'%s %s (%s)' % (prefix, menu_item.title, menu_item.url))
+        return lines
+    
+    def apply(self):
+        ''' Saves the changes. '''
+        from .models import MenuItem
         
-    menu.clean_item_order()
+        with transaction.atomic():
+            # existing parents of new items are added to the list, so that all parents are indexes
+            menu_items = list(self.new_items)
+            parents = []
+            for parent in self.parents:
+                if isinstance(parent, MenuItem):
+                    menu_items.append(parent)
+                    parent = len(menu_items) - 1
+                parents.append(parent)
+            parents.extend([None] * (len(menu_items) - len(parents)))
+            _save_new_items(self.menu, self.sitemap, menu_items, parents)
+            
+            for menu_item in self.changed_items:
+                if menu_item.id in self.new_parents:
+                    menu_item.my_parent_id = self.new_items[self.new_parents[menu_item.id]].id
+            update_items(self.changed_items, ITEM_FIELDS)
+            
+            for chunk in _chunks([menu_item.id for menu_item in self.deleted_items]):
+                MenuItem.objects.filter(pk__in=chunk).delete()
     
-def _refresh_menu_from_sitemap_items(menu, sitemap):
-    ''' Refreshes items that belong to give sitemap '''
-    def get_menu_items_for_sitemap_item(sitemap_item):
-        return menu.menuitem_set.filter(sitemap=sitemap, sitemap_item_id=sitemap_item['uuid'])
+            
+def _diff_menu_with_sitemap_items(menu, sitemap, sitemap_items):
+    ''' Finds changes of items that belong to given sitemap. '''
+    all_items = list(menu.menuitem_set.all())
+    original_values = dict((menu_item.id, _get_item_values(menu_item)) for menu_item in all_items)
     
-    current_menu_items = set()
+    items_by_uuid = {}
+    for menu_item in all_items:
+        if menu_item.sitemap_id == sitemap.id:
+            items_by_uuid.setdefault(menu_item.sitemap_item_id, []).append(menu_item)
     
     # update items belonging to this sitemap
-    for sitemap_item in sitemap.get_items():
-        for menu_item in get_menu_items_for_sitemap_item(sitemap_item):
+    current_ids = set()
+    for sitemap_item in sitemap_items:
+        for menu_item in items_by_uuid.get(sitemap_item['uuid'], ()):
             if sitemap_item.get('enabled', True):
                 menu_item.sitemap_item_status = 'enabled'
             else:
@@ -121,85 +316,78 @@ def _refresh_menu_from_sitemap_items(menu, sitemap):
             if 'location' in sitemap_item:
                 menu_item.url = sitemap_item['location']
             
-            menu_item.save()
-            current_menu_items.add(menu_item)
+            current_ids.add(menu_item.id)
     
     # deleted items to pages that don't exist any longer
-    items_to_delete = set()
-    for item in menu.menuitem_set.filter(sitemap=sitemap):
-        if item not in current_menu_items:
-            items_to_delete.add(item)
-            
-    for item in items_to_delete:
-        # flatten menu as needed
-        for child in menu.menuitem_set.filter(my_parent=item):
-            if item.parent in items_to_delete:
-                child.parent = None
-            else:
-                child.parent = item.parent
-            child.save()
+    diff = MenuDiff(menu, sitemap)
+    items_by_id = dict((menu_item.id, menu_item) for menu_item in all_items)
+    deleted_ids = set()
+    for menu_item in all_items:
+        if menu_item.sitemap_id == sitemap.id and menu_item.id not in current_ids:
+            diff.deleted_items.append(menu_item)
+            deleted_ids.add(menu_item.id)
     
-    for item in items_to_delete:
-        item.delete()
+    # flatten menu as needed
+    for menu_item in all_items:
+        if menu_item.my_parent_id in deleted_ids and menu_item.id not in deleted_ids:
+            parent_id = items_by_id[menu_item.my_parent_id].my_parent_id
+            menu_item.my_parent_id = None if parent_id in deleted_ids else parent_id
     
-            
-def _refresh_menu_from_sitemap_full(menu, sitemap):
-    ''' Refreshes entire menu based on a sitemap. '''
-    from .models import MenuItem
-    assert(menu.sitemap == sitemap)
+    for menu_item in all_items:
+        if menu_item.id not in deleted_ids and _get_item_values(menu_item) != original_values[menu_item.id]:
+            diff.changed_items.append(menu_item)
+    return diff
     
-    sitemap_items = list(sitemap.get_items())
+def _diff_menu_with_sitemap_full(menu, sitemap, sitemap_items):
+    ''' Finds changes that rebuild entire menu based on a sitemap.
     
-    # check if menu should be empty
-    if not sitemap_items:
-        menu.menuitem_set.all().delete()
-        return
+    Current menu items are loaded once and compared with the sitemap in memory.
+    Only new, changed and removed items are written to the database.
+    '''
+    from .models import MenuItem
+    assert(menu.sitemap == sitemap)
     
-    sitemap_has_tree = 'parent' in sitemap_items[0]
-    sitemap_has_order = 'order' in sitemap_items[0]
+    diff = MenuDiff(menu, sitemap)
     
-            
-    def find_parent_by_url(menu_item):
-        ''' Finds parent menu item '''
-        parent_url = get_parent_url(menu_item.url)
-
-        while parent_url:
-            try:
-                canditate_url = parent_url
-                if canditate_url != menu_item.url:
-                    return menu.menuitem_set.filter(url=canditate_url).get()
-            except ObjectDoesNotExist:
-                pass
-
-            try:
-                canditate_url = parent_url + "/"
-                if canditate_url != menu_item.url:
-                    return menu.menuitem_set.filter(url=canditate_url).get()
-            except ObjectDoesNotExist:
-                pass
-
-            parent_url = get_parent_url(parent_url)
-        return None
+    # read the sitemap once; one entry per uuid, the last one wins
+    entries = {}
+    uuids = []
+    sitemap_has_tree = False
+    sitemap_has_order = False
+    for s in sitemap_items:
+        if not uuids:
+            sitemap_has_tree = 'parent' in s
+            sitemap_has_order = 'order' in s
+        if s['uuid'] not in entries:
+            uuids.append(s['uuid'])
+        entries[s['uuid']] = s
     
-    # flatten menu
+    # load current state
+    existing_items = {}
     for menu_item in menu.menuitem_set.all():
-        menu_item.parent = None
-        menu_item.save()
-        
-    # remove items from other sitemaps
-    menu.menuitem_set.exclude(sitemap=sitemap).delete()
+        if menu_item.sitemap_id != sitemap.id or menu_item.sitemap_item_id in existing_items or menu_item.sitemap_item_id not in entries:
+            diff.deleted_items.append(menu_item)
+        else:
+            existing_items[menu_item.sitemap_item_id] = menu_item
+    
+    # check if menu should be empty
+    if not entries:
+        return diff
     
     # create new items and update existing items
-    current_menu_items = set()
-    for s in sitemap_items:
-        try:
-            menu_item = menu.menuitem_set.filter(sitemap_item_id=s['uuid']).get()
-        except ObjectDoesNotExist:
+    menu_items = []
+    original_values = {}
+    for uuid in uuids:
+        s = entries[uuid]
+        menu_item = existing_items.get(uuid)
+        if menu_item is None:
             menu_item = MenuItem()
             menu_item.menu = menu
             menu_item.status = 'auto'
             menu_item.sitemap = sitemap
-            menu_item.sitemap_item_id = s['uuid']
+            menu_item.sitemap_item_id = uuid
+        else:
+            original_values[menu_item.id] = _get_item_values(menu_item)
         
         if not menu_item.title or menu_item.sitemap_item_title == menu_item.title:
             menu_item.title = s.get('title', '')
@@ -210,46 +398,365 @@ def _refresh_menu_from_sitemap_full(menu, sitemap):
         else:
             menu_item.sitemap_item_status = 'disabled'
         menu_item.url = s.get('location', '')
-        menu_item.order = s.get('order', 1)  
-        menu_item.save()
-        
-        current_menu_items.add(menu_item)
-    
-    # remove old items
-    for menu_item in menu.menuitem_set.all():
-        if menu_item not in current_menu_items:
-            menu_item.delete()
+        menu_items.append(menu_item)
     
     # create hierarchy
     if sitemap_has_tree:
-        for s in (s for s in sitemap_items if s['parent']):
-            try:
-                menu_item = menu.menuitem_set.filter(sitemap_item_id=s['uuid']).get()
-                parent_item = menu.menuitem_set.filter(url=s['parent']).get()
-
-                menu_item.parent = parent_item
-                menu_item.save()
-            except ObjectDoesNotExist:
-                pass
-    else:            
-        for menu_item in menu.menuitem_set.all():
-            menu_item.parent = find_parent_by_url(menu_item)
-            menu_item.save()
-            
+        url_index = {}
+        for index, menu_item in enumerate(menu_items):
+            url_index.setdefault(menu_item.url, index)
+        
+        parents = []
+        for index, menu_item in enumerate(menu_items):
+            parent_url = entries[menu_item.sitemap_item_id].get('parent')
+            parent = url_index.get(parent_url) if parent_url else None
+            if parent == index:
+                parent = None
+            parents.append(parent)
+    else:
+        parents = infer_parents_by_url([menu_item.url for menu_item in menu_items])
+    _break_parent_cycles(parents)
+    
     # create order
     if sitemap_has_order:
-        for s in sitemap_items:        
-            try:
-                menu_item = menu.menuitem_set.filter(sitemap_item_id=s['uuid']).get()
-                menu_item.order = s['order']
-                menu_item.save()
-            except ObjectDoesNotExist:
-                pass
+        keys = [entries[menu_item.sitemap_item_id]['order'] for menu_item in menu_items]
     else:
-        for index, menu_item in enumerate(menu.menuitem_set.order_by('title')):
-            menu_item.order = index
-            menu_item.save()
+        keys = [menu_item.title for menu_item in menu_items]
+    for order, (index, depth, lft, rgt) in enumerate(get_tree_positions(parents, keys)):
+        menu_item = menu_items[index]
+        menu_item.order = order
+        menu_item.depth = depth
+        menu_item.lft = lft
+        menu_item.rgt = rgt
+    
+    # sort out new and changed items; parents of new items are new or existing items
+    new_indexes = {}
+    for index, menu_item in enumerate(menu_items):
+        if menu_item.id is None:
+            new_indexes[index] = len(new_indexes)
+    
+    for index, menu_item in enumerate(menu_items):
+        parent = parents[index]
+        if menu_item.id is None:
+            diff.new_items.append(menu_item)
+            if parent is None or parent in new_indexes:
+                diff.parents.append(new_indexes.get(parent))
+            else:
+                diff.parents.append(menu_items[parent])
+        else:
+            if parent is None:
+                menu_item.my_parent_id = None
+            elif parent in new_indexes:
+                # id of the parent is known after it's saved
+                menu_item.my_parent_id = None
+                diff.new_parents[menu_item.id] = new_indexes[parent]
+            else:
+                menu_item.my_parent_id = menu_items[parent].id
+            if menu_item.id in diff.new_parents or _get_item_values(menu_item) != original_values[menu_item.id]:
+                diff.changed_items.append(menu_item)
+    return diff
+
+ITEM_FIELDS = ('title', 'url', 'order', 'depth', 'lft', 'rgt', 'my_parent_id', 'sitemap_item_title', 'sitemap_item_status')
+CHUNK_SIZE = 500
+
+class StageTimer(object):
+    ''' Adds up time spent in named stages of work. It may be shared by many threads. '''
+    
+    def __init__(self):
+        self.totals = {}
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self.totals[name] = self.totals.get(name, 0) + elapsed
+
+def _get_item_values(menu_item):
+    return tuple(getattr(menu_item, name) for name in ITEM_FIELDS)
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _break_parent_cycles(parents):
+    ''' Detaches items whose ancestors form a cycle. 
+    
+    parents -- list of parent index or None for each item; it is modified in place
+    '''
+    state = [0] * len(parents) # 0 - not visited, 1 - in progress, 2 - done
+    for start in range(len(parents)):
+        path = []
+        index = start
+        while index is not None and state[index] == 0:
+            state[index] = 1
+            path.append(index)
+            index = parents[index]
+        if index is not None and state[index] == 1:
+            parents[index] = None
+        for index in path:
+            state[index] = 2
+
+def apply_menu_operations(menu, operations):
+    ''' Applies changes to menu items in one transaction.
+    
+    Each operation is a dict with "op" and "id" keys:
+    - insert - adds item; "id" is a temporary id that later operations can use;
+      other keys: "title", "url", "status", "sitemap_item_id", "parent_id", "position"
+    - move - changes parent; other keys: "parent_id", "position"
+    - rename - changes title; other keys: "title"
+    - set_status - changes status; other keys: "status"
+    - delete - deletes item and its descendants
+    
+    "position" is index of the item among its new siblings; by default the item is the last one.
+    Returns dict that maps temporary ids of inserted items to their ids.
+    '''
+    from .cache import batch_invalidation, invalidate_menus
+    from .models import MenuItem
     
+    fields = ('title', 'url', 'status', 'order', 'depth', 'lft', 'rgt', 'my_parent_id')
+    statuses = [choice[0] for choice in MenuItem.STATUS_CHOICES]
+    
+    # menus are invalidated after the transaction is committed
+    with batch_invalidation():
+        with transaction.atomic():
+            items = dict((item.id, item) for item in menu.menuitem_set.all())
+            original_values = dict((item.id, tuple(getattr(item, name) for name in fields)) for item in items.values())
+            keys = dict((item.id, item.order) for item in items.values())
+            new_ids = {}
+            deleted_ids = set()
+            
+            def get_item(item_id):
+                item_id = new_ids.get(item_id, item_id)
+                try:
+                    return items[int(item_id)]
+                except (KeyError, TypeError, ValueError):
+                    raise SuspiciousOperation("Unknown menu item: %s" % item_id)
+            
+            def get_parent_id(operation, item=None):
+                if operation.get('parent_id') in (None, ''):
+                    return None
+                parent = get_item(operation['parent_id'])
+                
+                # make sure parent isn't the item or its descendant
+                ancestor = parent
+                while item is not None and ancestor is not None:
+                    if ancestor.id == item.id:
+                        raise SuspiciousOperation("Menu item cannot be its own descendant.")
+                    ancestor = items.get(ancestor.my_parent_id)
+                return parent.id
+            
+            def place(item, parent_id, position):
+                siblings = [i for i in items.values() if i.my_parent_id == parent_id and i.id != item.id]
+                siblings.sort(key=lambda i: keys[i.id])
+                if position is None:
+                    position = len(siblings)
+                siblings.insert(max(0, min(int(position), len(siblings))), item)
+                
+                item.my_parent_id = parent_id
+                for key, sibling in enumerate(siblings):
+                    keys[sibling.id] = key
+            
+            for operation in operations:
+                op = operation.get('op')
+                
+                if op == 'insert':
+                    item = MenuItem()
+                    item.menu = menu
+                    item.title = operation.get('title', '')
+                    item.url = operation.get('url', '')
+                    item.status = operation.get('status', 'auto')
+                    item.sitemap_item_id = operation.get('sitemap_item_id')
+                    if item.status not in statuses:
+                        raise SuspiciousOperation("Invalid status: %s" % item.status)
+                    item.my_parent_id = get_parent_id(operation)
+                    item.save()
+                    
+                    items[item.id] = item
+                    original_values[item.id] = tuple(getattr(item, name) for name in fields)
+                    keys[item.id] = 0
+                    new_ids[operation.get('id')] = item.id
+                    place(item, item.my_parent_id, operation.get('position'))
+                elif op == 'move':
+                    item = get_item(operation.get('id'))
+                    place(item, get_parent_id(operation, item), operation.get('position'))
+                elif op == 'rename':
+                    get_item(operation.get('id')).title = operation.get('title', '')
+                elif op == 'set_status':
+                    if operation.get('status') not in statuses:
+                        raise SuspiciousOperation("Invalid status: %s" % operation.get('status'))
+                    get_item(operation.get('id')).status = operation['status']
+                elif op == 'delete':
+                    removed = set([get_item(operation.get('id')).id])
+                    found = True
+                    while found:
+                        found = False
+                        for i in items.values():
+                            if i.my_parent_id in removed and i.id not in removed:
+                                removed.add(i.id)
+                                found = True
+                    for item_id in removed:
+                        del items[item_id]
+                    deleted_ids.update(removed)
+                else:
+                    raise SuspiciousOperation("Unknown operation: %s" % op)
+            
+            # update position of all items
+            ids = list(items)
+            index_by_id = dict((item_id, index) for index, item_id in enumerate(ids))
+            parents = [index_by_id.get(items[item_id].my_parent_id) for item_id in ids]
+            positions = get_tree_positions(parents, [(keys[item_id], item_id) for item_id in ids])
+            for order, (index, depth, lft, rgt) in enumerate(positions):
+                item = items[ids[index]]
+                item.order = order
+                item.depth = depth
+                item.lft = lft
+                item.rgt = rgt
+            
+            # save changes; moved items are saved before their old parents are deleted
+            changed_items = [i for i in items.values() if tuple(getattr(i, name) for name in fields) != original_values[i.id]]
+            update_items(changed_items, fields)
+            
+            for chunk in _chunks(deleted_ids):
+                MenuItem.objects.filter(pk__in=chunk).delete()
+            
+            invalidate_menus()
+    
+    return new_ids
+
+def get_tree_positions(parents, keys):
+    ''' Returns positions of items in depth-first order.
+    
+    Siblings are sorted by their keys. Returns a list of (index, depth, lft, rgt)
+    tuples, where lft and rgt are nested set values. Items that can't be reached 
+    from top-level items are not included.
+    '''
+    children = {}
+    for index in sorted(range(len(parents)), key=lambda i: keys[i]):
+        children.setdefault(parents[index], []).append(index)
+    
+    positions = []
+    counter = 0
+    stack = [(index, 0, None) for index in reversed(children.get(None, []))]
+    while stack:
+        index, depth, position = stack.pop()
+        counter += 1
+        if position is None:
+            # entering the item
+            stack.append((index, depth, len(positions)))
+            positions.append((index, depth, counter, None))
+            stack.extend((child, depth + 1, None) for child in reversed(children.get(index, [])))
+        else:
+            # leaving the item
+            positions[position] = positions[position][:3] + (counter, )
+    return positions
+
+def _save_new_items(menu, sitemap, menu_items, parents):
+    ''' Inserts new items, one tree level at a time, so that parents get ids before their children. '''
+    from .models import MenuItem
+    
+    pending = [index for index, menu_item in enumerate(menu_items) if menu_item.id is None]
+    while pending:
+        ready = []
+        waiting = []
+        for index in pending:
+            parent = parents[index]
+            if parent is None or menu_items[parent].id is not None:
+                ready.append(index)
+            else:
+                waiting.append(index)
+        
+        for index in ready:
+            parent = parents[index]
+            menu_items[index].my_parent_id = menu_items[parent].id if parent is not None else None
+        MenuItem.objects.bulk_create([menu_items[index] for index in ready])
+        
+        # bulk_create doesn't set ids
+        index_by_uuid = dict((menu_items[index].sitemap_item_id, index) for index in ready)
+        for chunk in _chunks(index_by_uuid.keys()):
+            for uuid, pk in menu.menuitem_set.filter(sitemap=sitemap, sitemap_item_id__in=chunk).values_list('sitemap_item_id', 'id'):
+                menu_items[index_by_uuid[uuid]].id = pk
+        pending = waiting
+
+def update_items(menu_items, fields):
+    ''' Writes given fields of items.
+    
+    Each chunk of items is written by one UPDATE statement executed with
+    parameters of all its items, so the number of queries doesn't depend on
+    the number of changed items.
+    '''
+    from django.db import connections, router
+    from .models import MenuItem
+    
+    connection = connections[router.db_for_write(MenuItem)]
+    model_fields = dict((f.attname, f) for f in MenuItem._meta.fields)
+    qn = connection.ops.quote_name
+    
+    sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+        qn(MenuItem._meta.db_table),
+        ', '.join('%s = %%s' % qn(model_fields[name].column) for name in fields),
+        qn(MenuItem._meta.pk.column))
+    
+    for chunk in _chunks(menu_items):
+        params = []
+        for menu_item in chunk:
+            values = [model_fields[name].get_db_prep_save(getattr(menu_item, name), connection=connection) for name in fields]
+            params.append(values + [menu_item.id])
+        connection.cursor().executemany(sql, params)
+    
+def infer_parents_by_url(urls):
+    ''' Finds parent of each URL based on URL paths. 
+    
+    Parent is the closest URL in the list that is an ancestor path, 
+    with or without trailing slash. Example: "/fishes/" is parent of "/fishes/goldfish/".
+    
+    Returns list with index of parent URL, or None, for each URL.
+    '''
+    url_index = {}
+    for index, url in enumerate(urls):
+        url_index.setdefault(normalize_url(url), []).append(index)
+    
+    parent_urls = {}
+    def get_cached_parent_url(url):
+        if url not in parent_urls:
+            parent_urls[url] = get_parent_url(url)
+        return parent_urls[url]
+    
+    parents = []
+    for index, url in enumerate(urls):
+        parent = None
+        parent_url = get_cached_parent_url(url)
+        while parent_url and parent is None:
+            for candidate in url_index.get(normalize_url(parent_url), []):
+                if urls[candidate] != url:
+                    parent = candidate
+                    break
+            parent_url = get_cached_parent_url(parent_url)
+        parents.append(parent)
+    return parents
+
+def normalize_url(url):
+    ''' Removes trailing slash, so that "/fishes/" and "/fishes" are the same. '''
+    if len(url) > 1 and url.endswith('/'):
+        return url[:-1]
+    return url
+
+def split_url_path(url):
+    ''' Returns segments of URL path, ex: ["fishes", "goldfish"] for "/fishes/goldfish/?page=2". 
+    
+    Returns None for URLs to other hosts. '''
+    from urlparse import urlsplit
+    
+    url_parts = urlsplit(url)
+    if url_parts.netloc:
+        return None
+    return [segment for segment in url_parts.path.split('/') if segment]
+
 def get_parent_url(url):
     from urlparse import urlsplit, urldefrag, urljoin
     from os.path import dirname